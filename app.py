@@ -1,51 +1,89 @@
 import datetime
+import io
+import logging
+import re
+import time
 from functools import wraps
 from time import sleep
-from flask import Flask, make_response, redirect, send_file, jsonify, request, render_template, url_for
+from flask import Flask, Response, g, make_response, redirect, send_file, jsonify, request, render_template, url_for
 import db
 import os
 from werkzeug.utils import secure_filename
-import subprocess
 import utils
-import shutil
 import config
-import machines
+import heartbeat
+import downloads
+import builder
+import jobs
+import keypool
+import events
+import metrics
+import tracing
+import services
+import store
+import rootfs
+import boots
+import fleet
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = "squash"
 app.config['STYLE_FOLDER'] = "style"
 app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 512  # 512MB
 
+logging.basicConfig(level=config.log_level)
+db.connect()
+jobs.fail_interrupted_jobs()
 utils.init_threads()
+if config.run_services_in_app:
+    services.start()
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+    if config.db_trace:
+        tracing.start(request.url_rule.rule if request.url_rule is not None else request.path)
+
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.http_requests.inc(route, request.method, str(response.status_code))
+    metrics.http_request_seconds.observe(time.perf_counter() - g.started,
+                                         route, request.method)
+    trace = tracing.stop() if config.db_trace else None
+    if trace is not None:
+        response.headers["X-DB-Queries"] = str(len(trace.statements))
+        response.headers["X-DB-Time"] = f"{trace.total() * 1000:.1f}ms"
+        tracing.log_trace(trace, request.method, response.status_code)
+    return response
+
 
 def login_required(f):
     @wraps(f)
     def login_function(*args, **kwargs):
         auth_token = request.cookies.get('auth_token')
-        if auth_token != "" or auth_token is not None:
-            if db.get_user_bytoken(auth_token) is None:
-                return redirect("/login")
+        if not auth_token or db.get_user_bytoken(auth_token) is None:
+            return redirect("/login")
         return f(*args, **kwargs)
     return login_function
 
 def is_logged(auth_token):
-    if auth_token != "" or auth_token is not None:
-        if db.get_user_bytoken(auth_token) is not None:
-            return True
-        
+    if auth_token and db.get_user_bytoken(auth_token) is not None:
+        return True
+
     return False
 
 @app.route('/')
 @login_required
 def main():
-    machines_all = db.get_machines()
+    machines_all = fleet.get_machines()
     return render_template('index.html', ssh_port=config.webssh_port, machines=machines_all.machines)
 
 
 @app.route('/login')
 def login():
     if is_logged(request.cookies.get('auth_token')) is True:
-        machines_all = db.get_machines()
+        machines_all = fleet.get_machines()
         return render_template('index.html', ssh_port=config.webssh_port, machines=machines_all.machines)
     return render_template('login.html')
 
@@ -63,7 +101,7 @@ def logout():
 @app.route('/images')
 @login_required
 def list_images():
-    images_all = db.get_images()
+    images_all = fleet.get_images()
     return render_template("images.html", images=images_all.images)
 
 
@@ -84,44 +122,130 @@ def create_conf_post():
         password = request.form['pass']
     except:
         return jsonify(message="400")
-    if db.get_conf_id_name(config_name+".squashfs") is not None:
+    params = {"config_name": config_name, "token_name": token_name,
+              "key_length": key_length, "ip": ip}
+    job_id = jobs.queue.submit(
+        "createconf", params, builder.create_config, config_name, token_name,
+        key_length, ip, password, request.form.get('authorized_keys_config'),
+        app.config['UPLOAD_FOLDER'],
+        reserve=([config_name+".squashfs"], [token_name]))
+    if job_id is None:
+        return jsonify(message="400")
+
+    if request.form.get('ui'):
+        return redirect(url_for('show_job', job_id=job_id))
+    return jsonify(message="202", job_id=job_id,
+                   status_url=url_for('job_status', job_id=job_id))
+
+
+@app.route('/api/createconf/batch', methods=['POST'])
+@login_required
+def create_conf_batch_post():
+    try:
+        prefix = request.form['prefix']
+        count = int(request.form['count'])
+        ip = request.form['ip']
+        key_length = request.form['key_length']
+        password = request.form['pass']
+    except:
         return jsonify(message="400")
-    if db.get_conf_id(token_name) is not None:
+    if count < 1 or count > config.batch_max_count or not utils.is_valid_ip_address(ip):
         return jsonify(message="400")
-    folder = utils.generate_random_string(5)
     try:
-        os.mkdir(os.path.join(os.getcwd(), 'configs', folder))
-        authorized_keys_config = request.form['authorized_keys_config']
-        authorized_keys_file = open(folder+"/authorized_keys", "w")
-        authorized_keys_file.write(authorized_keys_config + "\n")
-        authorized_keys_file.close()
+        names = [name for name, _ in builder.batch_names(prefix, count, ip)]
+    except ValueError:
+        return jsonify(message="400")
+
+    params = {"prefix": prefix, "count": count, "ip": ip,
+              "key_length": key_length}
+    job_id = jobs.queue.submit(
+        "createconf_batch", params, builder.create_configs_batch, prefix,
+        count, ip, key_length, password,
+        request.form.get('authorized_keys_config'), app.config['UPLOAD_FOLDER'],
+        reserve=([name+".squashfs" for name in names], names))
+    if job_id is None:
+        return jsonify(message="400")
+
+    if request.form.get('ui'):
+        return redirect(url_for('show_job', job_id=job_id))
+    return jsonify(message="202", job_id=job_id,
+                   status_url=url_for('job_status', job_id=job_id))
+
+
+@app.route('/rootfs')
+@login_required
+def rootfs_form():
+    return render_template("rootfs.html", sources=rootfs.sources())
+
+
+@app.route('/api/rootfs', methods=['POST'])
+@login_required
+def rootfs_post():
+    try:
+        source = request.form['source']
+        name = secure_filename(request.form['name'])
+        packages = request.form.get('packages', '').split()
+        upgrade = bool(request.form.get('upgrade'))
+        profile = request.form.get('profile', 'release')
     except:
-        shutil.copy('./configs/authorized_keys',
-                    './configs/' + folder+"/authorized_keys")
-
-    script_path = os.path.join(os.getcwd(), 'configs', "create.sh")
-    ini_path = os.path.join(os.getcwd(), 'configs', "uVPN.ini")
-    conf_path = os.path.join(os.getcwd(), 'configs', "uVPN.conf")
-    pub_path = os.path.join(os.getcwd(), 'configs', "server.pub")
-    authorized_keys_path = os.path.join(
-        os.getcwd(), 'configs', folder, "authorized_keys")
-    sshd_config_path = os.path.join(os.getcwd(), 'configs', "sshd_config")
-    sendmail_path = os.path.join(os.getcwd(), 'configs', "sendmail.sh")
-    msmtp_conf = os.path.join(os.getcwd(), 'configs', "msmtprc")
-    scripts = os.path.join(os.getcwd(), 'configs', "scripts")
-    
-    subprocess.run([script_path, "-i "+ini_path, "-c "+conf_path, 
-                    "-k "+pub_path, "-l "+key_length, "-n"+config_name,
-                    "-p "+ip, "-a "+authorized_keys_path, "-d "+sshd_config_path, 
-                    "-m "+sendmail_path, "-o "+msmtp_conf, "-s "+scripts," > /dev/null 2>&1 "])
-
-    if os.path.exists(folder):
-        shutil.rmtree(folder)
-    output = subprocess.run(
-        ['openssl', 'passwd', '-6', password], capture_output=True, text=True)
-    db.add_conf_image(config_name+".squashfs", token_name, ip, output.stdout)
-
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], config_name+".pub"))
+        return jsonify(message="400")
+    if source not in rootfs.sources() or not name or profile not in rootfs.PROFILES:
+        return jsonify(message="400")
+    if any(rootfs.PACKAGE_NAME.fullmatch(package) is None for package in packages):
+        return jsonify(message="400")
+
+    params = {"source": source, "name": name, "packages": packages,
+              "upgrade": upgrade, "profile": profile}
+    job_id = jobs.queue.submit(
+        "rootfs", params, rootfs.build_rootfs,
+        os.path.join(config.rootfs_folder, source), name, packages, upgrade,
+        profile, config.rootfs_folder)
+
+    if request.form.get('ui'):
+        return redirect(url_for('show_job', job_id=job_id))
+    return jsonify(message="202", job_id=job_id,
+                   status_url=url_for('job_status', job_id=job_id))
+
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+def show_job(job_id):
+    return render_template("job.html", job_id=job_id)
+
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    job = jobs.queue.get(job_id)
+    if job is None:
+        return jsonify(message="404"), 404
+    result = job["result"] or {}
+    if job["status"] == "done" and ("pub" in result or "pubs" in result):
+        job["key_url"] = url_for('job_key', job_id=job_id)
+    return jsonify(job)
+
+
+@app.route('/api/jobs/<int:job_id>/key')
+@login_required
+def job_key(job_id):
+    job = db.get_job(job_id)
+    if job is None:
+        return jsonify(message="404"), 404
+    if job["status"] != "done":
+        return jsonify(message="409"), 409
+    result = job["result"] or {}
+    if "pubs" in result:
+        keys_zip = io.BytesIO()
+        builder.write_keys_zip(keys_zip, result["pubs"], app.config['UPLOAD_FOLDER'])
+        keys_zip.seek(0)
+        return send_file(keys_zip, as_attachment=True,
+                         download_name=f"job-{job_id}-keys.zip",
+                         mimetype="application/zip")
+    if "pub" not in result:
+        # rootfs jobs have no key
+        return jsonify(message="404"), 404
+    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], result["pub"]),
+                     as_attachment=True)
 
 
 @app.route('/api/login', methods=['POST'])
@@ -151,9 +275,12 @@ def delete(image_id):
         app.config['UPLOAD_FOLDER'], filename.split(".")[0]+".pub")
     if os.path.exists(squashfs):
         os.remove(squashfs)
+        downloads.invalidate_etag(squashfs)
     if os.path.exists(pubkey):
         os.remove(pubkey)
-    db.del_image(image_id)
+    unreferenced = db.del_image(image_id)
+    if unreferenced:
+        store.remove(unreferenced, app.config['UPLOAD_FOLDER'])
 
     return redirect(url_for('list_images'))
 
@@ -170,35 +297,46 @@ def download_key(image_id):
 
 @app.route("/api/getconf")
 def get_image():
+    filename = None
+    digest = None
     try:
-        filename = db.get_conf_image(request.headers['token'])
-    except:
-        pass
-    try:
-        date = db.get_image_allocation_time(request.headers['token'])
-        if date is not None:
-            delta = datetime.datetime.now() - date
-            if delta.total_seconds() > 30:
-                db.del_image_allocation_token(request.headers['token'])
-            else:
-                filename = None
-        else:
-            db.set_image_allocation(
-                request.headers['token'], request.remote_addr)
+        filename, digest = db.allocate_image(
+            request.headers['token'], request.remote_addr,
+            config.allocation_takeover_timeout)
     except:
         pass
+    if filename:
+        events.bus.publish("allocated", name=request.headers['token'],
+                           image_name=filename, ipvpn=None,
+                           iplocal=request.remote_addr, username="root",
+                           start_time=datetime.datetime.utcnow().isoformat())
 
     if filename is None or filename == "":
         filename = config.default_file
+        digest = None
+
+    return downloads.send_image(app.config['UPLOAD_FOLDER'], filename,
+                                digest=digest)
 
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+
+@app.route("/api/getbase/<string:name>")
+def get_base(name):
+    if re.fullmatch(r"base-[0-9a-f]{16}", name) is None:
+        return "", 404
+    if fleet.get_image_id_by_token(request.headers.get('token')) is None:
+        return "", 404
+    if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], name+".squashfs")):
+        return "", 404
+    return downloads.send_image(app.config['UPLOAD_FOLDER'], name+".squashfs",
+                                shared=True)
 
 
 @app.route("/api/getpass")
 def get_pass():
     try:
-        password = db.get_conf_password(request.headers['token'])
-        return password
+        image = db.get_conf_by_token(request.headers['token'])
+        boots.buffer.record(image.id, "getpass")
+        return image.password
     except:
         return ""
 
@@ -206,14 +344,16 @@ def get_pass():
 @app.route("/api/release_allocation", methods=['POST'])
 def release_allocation():
     try:
-        id_allocation = db.get_conf_id_name(
+        id_allocation = fleet.get_image_id_by_name(
             request.headers['name']+".squashfs")
         if id_allocation is None or id_allocation == "":
             return jsonify(message="400")
     except:
         return jsonify(message="400")
     if id_allocation is not None:
-        db.del_image_allocation_id_image(id_allocation)
+        token = db.release_allocation(id_allocation)
+        if token is not None:
+            events.bus.publish("released", name=token)
     else:
         return jsonify(message="404")
 
@@ -230,11 +370,118 @@ def add_ip():
     except:
         return jsonify(message="400")
     if db.update_image_allocation_ip_vpn(token, ip) is not None:
+        heartbeat.buffer.beat(fleet.get_image_id_by_token(token), token)
+        boots.buffer.record(fleet.get_image_id_by_token(token), "addip")
+        events.bus.publish("ip", name=token, ipvpn=ip)
         return jsonify(message="200")
     else:
         return jsonify(message="400")
 
 
+@app.route("/api/heartbeat", methods=['POST'])
+def heartbeat_api():
+    image_id = fleet.get_image_id_by_token(request.headers.get('token'))
+    if image_id is None:
+        return "", 404
+    heartbeat.buffer.beat(image_id, request.headers.get('token'))
+    return "", 204
+
+
+@app.route("/api/bootevent", methods=['POST'])
+def boot_event():
+    stage = request.form.get('stage', '')
+    if not boots.is_client_phase(stage):
+        return "", 400
+    image_id = fleet.get_image_id_by_token(request.headers.get('token'))
+    if image_id is None:
+        return "", 404
+    boots.buffer.record(image_id, stage)
+    return "", 204
+
+
+@app.route("/boots")
+@login_required
+def list_boots():
+    try:
+        hours = int(request.args.get('hours', 24))
+    except ValueError:
+        hours = 24
+    return render_template("boots.html", hours=hours,
+                           stats=db.get_boot_stats(hours),
+                           boots=db.get_boots(100, hours))
+
+
+@app.route("/api/boots/stats")
+@login_required
+def boot_stats():
+    try:
+        hours = int(request.args.get('hours', 24))
+    except ValueError:
+        return jsonify(message="400")
+    return jsonify(hours=hours, phases=db.get_boot_stats(hours))
+
+
+@app.route("/api/machines")
+@login_required
+def list_machines():
+    try:
+        limit = int(request.args.get('limit', 100))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify(message="400")
+    order = request.args.get('order', 'asc')
+    if limit < 1 or limit > 1000 or offset < 0 or order not in ('asc', 'desc'):
+        return jsonify(message="400")
+    try:
+        machines_page, total = fleet.get_machines().page(
+            limit=limit, offset=offset, order=order,
+            image_name=request.args.get('image'))
+    except:
+        return jsonify(message="500")
+    return jsonify(total=total, limit=limit, offset=offset,
+                   machines=[machine.to_dict() for machine in machines_page])
+
+
+@app.route("/api/machines/stream")
+@login_required
+def machines_stream():
+    # subscribe before the snapshot so no change falls in between
+    subscriber = events.bus.subscribe()
+    try:
+        machines_list = fleet.get_machines().machines
+    except:
+        machines_list = []
+
+    def stream():
+        try:
+            yield events.format_event(
+                "snapshot", [machine.to_dict() for machine in machines_list])
+            while not subscriber.dropped:
+                event = subscriber.get(config.event_keepalive)
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield events.format_event(*event)
+        finally:
+            events.bus.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/api/cache_stats")
+@login_required
+def cache_stats():
+    return jsonify(token_cache=db.token_cache.stats(),
+                   session_cache=db.session_cache.stats(),
+                   keypool=keypool.pool.stats())
+
+
+@app.route("/metrics")
+def metrics_api():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/style/<string:name>")
 def get_style(name):
     try:
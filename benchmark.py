@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import db
+
+UPLOAD_FOLDER = "squash"
+ENDPOINTS = ["getconf", "addip", "getpass", "release_allocation"]
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.fallbacks = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, latency, ok):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def request(url, headers, data=None, timeout=30):
+    body = None
+    if data is not None:
+        body = urllib.parse.urlencode(data).encode()
+    req = urllib.request.Request(url, data=body, headers=headers,
+                                 method="POST" if data is not None else "GET")
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            payload = response.read()
+            status = response.status
+    except urllib.error.HTTPError as ex:
+        payload = b""
+        status = ex.code
+    except OSError:
+        payload = b""
+        status = 0
+    return time.perf_counter() - started, status, payload
+
+
+def is_ok(status, payload):
+    if status < 200 or status >= 400:
+        return False
+    # the API reports errors as {"message": "400"} with HTTP 200
+    try:
+        message = json.loads(payload).get("message")
+    except (ValueError, AttributeError):
+        return True
+    return message in (None, "200")
+
+
+def boot_client(args, results, name, index):
+    headers = {"token": name}
+    base = args.url.rstrip("/") + "/api/"
+
+    latency, status, payload = request(base + "getconf", headers)
+    results.record("getconf", latency, 200 <= status < 400)
+    with results.lock:
+        results.bytes += len(payload)
+        if len(payload) != args.image_size:
+            results.fallbacks += 1
+
+    ip = f"10.{100 + index // 65536 % 100}.{index // 256 % 256}.{index % 256}"
+    latency, status, payload = request(base + "addip", headers, {"ip": ip})
+    results.record("addip", latency, is_ok(status, payload))
+
+    latency, status, payload = request(base + "getpass", headers)
+    results.record("getpass", latency, 200 <= status < 400 and payload != b"")
+
+    time.sleep(args.hold)
+    latency, status, payload = request(
+        base + "release_allocation", {"name": name}, {})
+    results.record("release_allocation", latency, is_ok(status, payload))
+
+
+def db_query_count():
+    try:
+        with db.get_cur() as cur:
+            cur.execute("SELECT sum(calls) FROM pg_stat_statements")
+            return "statements", int(cur.fetchone()[0] or 0)
+    except Exception:
+        pass
+    with db.get_cur() as cur:
+        cur.execute("""
+            SELECT xact_commit + xact_rollback FROM pg_stat_database
+            WHERE datname = current_database()""")
+        return "transactions", int(cur.fetchone()[0])
+
+
+def seed(names, image_size):
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    for name in names:
+        with open(os.path.join(UPLOAD_FOLDER, name + ".squashfs"), "wb") as file:
+            file.write(os.urandom(image_size))
+        db.add_conf_image(name + ".squashfs", name, None, "bench")
+
+
+def cleanup(names):
+    for name in names:
+        image_id = db.get_conf_id(name)
+        if image_id is not None:
+            db.del_image_allocation_id_image(image_id)
+            db.del_image(image_id)
+        path = os.path.join(UPLOAD_FOLDER, name + ".squashfs")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def report(args, results, elapsed, query_kind, queries):
+    summary = {"clients": args.clients, "rate": args.rate,
+               "elapsed": elapsed, "endpoints": {}}
+    for endpoint in ENDPOINTS:
+        latencies = results.latencies[endpoint]
+        summary["endpoints"][endpoint] = {
+            "requests": len(latencies),
+            "errors": results.errors[endpoint],
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": max(latencies, default=0) * 1000,
+        }
+    total = sum(len(values) for values in results.latencies.values())
+    summary["requests"] = total
+    summary["throughput"] = total / elapsed if elapsed else 0.0
+    summary["bytes"] = results.bytes
+    summary["default_image_served"] = results.fallbacks
+    summary["db_" + query_kind] = queries
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"{'endpoint':<20}{'requests':>10}{'errors':>8}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for endpoint, stats in summary["endpoints"].items():
+        print(f"{endpoint:<20}{stats['requests']:>10}{stats['errors']:>8}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    print(f"elapsed: {elapsed:.2f}s, throughput: {summary['throughput']:.1f} req/s, "
+          f"bytes: {results.bytes}")
+    print(f"default image served: {results.fallbacks}")
+    print(f"db {query_kind}: {queries} ({queries / max(args.clients, 1):.1f} per client)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate a lab of machines booting against the client API")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=20.0,
+                        help="client arrivals per second")
+    parser.add_argument("--poisson", action="store_true",
+                        help="exponential inter-arrival times instead of a fixed rate")
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--hold", type=float, default=1.0,
+                        help="seconds between getpass and release_allocation")
+    parser.add_argument("--image-size", type=int, default=64 * 1024)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the seeded images after the run")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    prefix = "bench-" + str(int(time.time()))
+    names = [f"{prefix}-{i}" for i in range(args.clients)]
+    seed(names, args.image_size)
+    try:
+        results = Results()
+        query_kind, queries_before = db_query_count()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            at = started
+            for index, name in enumerate(names):
+                if args.poisson:
+                    at += random.expovariate(args.rate)
+                else:
+                    at = started + index / args.rate
+                delay = at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(boot_client, args, results, name, index)
+        elapsed = time.perf_counter() - started
+        if query_kind == "transactions":
+            # pg_stat_database is only updated when backends flush their stats
+            time.sleep(1.5)
+        _, queries_after = db_query_count()
+        report(args, results, elapsed, query_kind, queries_after - queries_before)
+    finally:
+        if not args.keep:
+            cleanup(names)
+
+
+if __name__ == "__main__":
+    main()
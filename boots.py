@@ -0,0 +1,55 @@
+import logging
+import re
+import threading
+import time
+from time import sleep
+import config
+import db
+
+# phases recorded by the server itself, clients may report any other name
+SERVER_PHASES = ("addip", "getpass", "seen")
+CLIENT_PHASE = re.compile(r"[a-z][a-z0-9_]{0,31}")
+
+log = logging.getLogger(__name__)
+
+
+class BootEventBuffer:
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def record(self, image_id, phase):
+        # the database turns ages into times, boots are started by its clock
+        now = time.monotonic()
+        with self.lock:
+            self.pending.setdefault((image_id, phase), now)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        now = time.monotonic()
+        try:
+            return db.add_boot_events({key: now - at for key, at in pending.items()})
+        except:
+            with self.lock:
+                for key, at in pending.items():
+                    self.pending[key] = min(at, self.pending.get(key, at))
+            raise
+
+
+buffer = BootEventBuffer()
+
+
+def is_client_phase(phase):
+    return CLIENT_PHASE.fullmatch(phase) is not None and phase not in SERVER_PHASES
+
+
+def flush_thread_function():
+    while True:
+        sleep(config.heartbeat_flush_interval)
+        try:
+            buffer.flush()
+        except Exception as ex:
+            log.warning(f"Boot event flush failed: {ex}")
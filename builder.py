@@ -0,0 +1,307 @@
+import argparse
+import fcntl
+import hashlib
+import ipaddress
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import config
+import db
+import utils
+import keypool
+import store
+
+# starttap.sh brings the VPN interface up as a /24
+VPN_PREFIX = 24
+
+
+def prepare_authorized_keys(authorized_keys):
+    configs = os.path.join(os.getcwd(), 'configs')
+    folder = os.path.join(configs, utils.generate_random_string(5))
+    os.mkdir(folder)
+    authorized_keys_path = os.path.join(folder, "authorized_keys")
+    if authorized_keys:
+        with open(authorized_keys_path, "w") as authorized_keys_file:
+            authorized_keys_file.write(authorized_keys + "\n")
+    else:
+        shutil.copy(os.path.join(configs, 'authorized_keys'),
+                    authorized_keys_path)
+    return folder
+
+
+def base_inputs():
+    # everything create.sh puts into the shared base image
+    configs = os.path.join(os.getcwd(), 'configs')
+    paths = [os.path.join(configs, name) for name in
+             ("create.sh", "server.pub", "sshd_config", "sendmail.sh",
+              "msmtprc", "authorized_keys")]
+    scripts = os.path.join(configs, "scripts")
+    paths += [os.path.join(scripts, name) for name in sorted(os.listdir(scripts))]
+    return paths
+
+
+def base_image_name():
+    digest = hashlib.sha256()
+    for path in base_inputs():
+        digest.update(os.path.relpath(path).encode() + b"\0")
+        with open(path, "rb") as file:
+            digest.update(file.read())
+    return "base-" + digest.hexdigest()[:16]
+
+
+def ensure_base_image(upload_folder, log=subprocess.PIPE):
+    name = base_image_name()
+    path = os.path.join(upload_folder, name + ".squashfs")
+    if os.path.exists(path):
+        return name
+    os.makedirs(upload_folder, exist_ok=True)
+    with open(os.path.join(upload_folder, ".base.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            return name
+        # built under a temporary name, an interrupted build is never served
+        partial = name + ".partial"
+        partial_path = os.path.join(upload_folder, partial + ".squashfs")
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        configs = os.path.join(os.getcwd(), 'configs')
+        subprocess.run(
+            [os.path.join(configs, "create.sh"), "-S", "-n"+partial,
+             "-k "+os.path.join(configs, "server.pub"),
+             "-a "+os.path.join(configs, "authorized_keys"),
+             "-d "+os.path.join(configs, "sshd_config"),
+             "-m "+os.path.join(configs, "sendmail.sh"),
+             "-o "+os.path.join(configs, "msmtprc"),
+             "-s "+os.path.join(configs, "scripts"),
+             "-t"+os.path.abspath(config.toolchain_dir)],
+            stdout=log, stderr=subprocess.STDOUT, text=True)
+        if not os.path.exists(partial_path):
+            raise RuntimeError(f"create.sh did not create the base image {name}")
+        os.replace(partial_path, path)
+    return name
+
+
+def build_image(config_name, key_length, ip, authorized_keys_path,
+                private_key, upload_folder, log=subprocess.PIPE, base=None):
+    configs = os.path.join(os.getcwd(), 'configs')
+    script_path = os.path.join(configs, "create.sh")
+    ini_path = os.path.join(configs, "uVPN.ini")
+    conf_path = os.path.join(configs, "uVPN.conf")
+    pub_path = os.path.join(configs, "server.pub")
+    sshd_config_path = os.path.join(configs, "sshd_config")
+    sendmail_path = os.path.join(configs, "sendmail.sh")
+    msmtp_conf = os.path.join(configs, "msmtprc")
+    scripts = os.path.join(configs, "scripts")
+    os.makedirs(upload_folder, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".build-", dir=upload_folder)
+    try:
+        result = subprocess.run(
+            [script_path, "-i "+ini_path, "-c "+conf_path,
+             "-k "+pub_path, "-l "+key_length, "-n"+config_name,
+             "-p "+ip, "-d "+sshd_config_path,
+             "-m "+sendmail_path, "-o "+msmtp_conf, "-s "+scripts,
+             "-t"+os.path.abspath(config.toolchain_dir),
+             "-O"+os.path.abspath(staging)]
+            + (["-a "+authorized_keys_path] if authorized_keys_path else [])
+            + (["-r"+private_key] if private_key else [])
+            + (["-B"+base] if base else []),
+            stdout=log, stderr=subprocess.STDOUT, text=True)
+
+        if not os.path.exists(os.path.join(staging, config_name+".squashfs")):
+            raise RuntimeError(
+                f"create.sh exited with {result.returncode} without creating {config_name}.squashfs\n"
+                + (result.stdout or ""))
+        # replaced rather than written into, the named files in the upload
+        # folder are hardlinks to content-addressed blobs
+        for extension in (".pub", ".squashfs"):
+            os.replace(os.path.join(staging, config_name+extension),
+                       os.path.join(upload_folder, config_name+extension))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return result.stdout
+
+
+def take_key(key_length):
+    if key_length.strip().isdigit():
+        return keypool.pool.take(int(key_length))
+    return None
+
+
+def hash_password(password):
+    output = subprocess.run(['openssl', 'passwd', '-6', password],
+                            capture_output=True, text=True, check=True)
+    return output.stdout
+
+
+def image_base(upload_folder, log):
+    if not config.overlay_images:
+        return None
+    return ensure_base_image(upload_folder, log)
+
+
+def authorized_keys_path(folder, authorized_keys, base):
+    # the default keys are part of the base image
+    if base and not authorized_keys:
+        return None
+    return os.path.join(folder, "authorized_keys")
+
+
+def create_config(config_name, token_name, key_length, ip, password,
+                  authorized_keys, upload_folder, log):
+    base = image_base(upload_folder, log)
+    folder = prepare_authorized_keys(authorized_keys)
+    private_key = take_key(key_length)
+    try:
+        build_image(config_name, key_length, ip,
+                    authorized_keys_path(folder, authorized_keys, base),
+                    private_key, upload_folder, log, base)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        if private_key:
+            os.remove(private_key)
+
+    stored = ()
+    try:
+        stored = store_image(config_name, upload_folder)
+        db.add_conf_image(config_name+".squashfs", token_name, ip,
+                          hash_password(password), *stored)
+    except:
+        remove_images([config_name], upload_folder, [stored])
+        raise
+    keypool.pool.refill()
+    return {"image": config_name+".squashfs", "pub": config_name+".pub"}
+
+
+def store_image(name, upload_folder):
+    return (store.put(os.path.join(upload_folder, name+".squashfs"), upload_folder),
+            store.put(os.path.join(upload_folder, name+".pub"), upload_folder))
+
+
+def batch_names(prefix, count, ip):
+    first_ip = ipaddress.ip_address(ip)
+    network = ipaddress.ip_interface(f"{ip}/{VPN_PREFIX}").network
+    last_ip = first_ip + count - 1
+    # the network and broadcast addresses cannot be given to a machine
+    if first_ip == network.network_address or last_ip >= network.broadcast_address:
+        raise ValueError(f"{count} addresses from {ip} do not fit in {network}")
+    width = max(3, len(str(count)))
+    return [(f"{prefix}{i:0{width}d}", str(first_ip + i - 1))
+            for i in range(1, count + 1)]
+
+
+def remove_images(names, upload_folder, stored=()):
+    # stored holds the (image_blob, pub_blob) pairs already put into the store
+    for name in names:
+        for extension in (".squashfs", ".pub"):
+            path = os.path.join(upload_folder, name + extension)
+            if os.path.exists(path):
+                os.remove(path)
+    digests = [blob[0] for blobs in stored for blob in blobs if blob]
+    if not digests:
+        return
+    try:
+        store.remove_unreferenced(digests, upload_folder)
+    except:
+        # left for store.py --gc
+        pass
+
+
+def create_configs_batch(prefix, count, ip, key_length, password,
+                         authorized_keys, upload_folder, log):
+    machines = batch_names(prefix, count, ip)
+    base = image_base(upload_folder, log)
+    folder = prepare_authorized_keys(authorized_keys)
+    private_keys = [take_key(key_length) for _ in machines]
+    built = []
+    failed = []
+    try:
+        # the work is done by create.sh, threads only wait for it; a process
+        # pool would re-import the server's main module in every worker
+        with ThreadPoolExecutor(max_workers=config.build_workers,
+                                thread_name_prefix="build") as executor:
+            futures = {
+                executor.submit(build_image, name, key_length, machine_ip,
+                                authorized_keys_path(folder, authorized_keys, base),
+                                private_key, upload_folder, base=base): name
+                for (name, machine_ip), private_key in zip(machines, private_keys)}
+            for future, name in futures.items():
+                try:
+                    output = future.result()
+                    built.append(name)
+                    log.write(f"==> {name}\n{output}")
+                except Exception as ex:
+                    failed.append(name)
+                    log.write(f"==> {name} failed\n{ex}\n")
+                log.flush()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        for private_key in private_keys:
+            if private_key:
+                os.remove(private_key)
+
+    if failed:
+        remove_images(built, upload_folder)
+        raise RuntimeError(f"{len(failed)} of {count} images failed: {', '.join(failed)}")
+
+    stored = []
+    try:
+        password_hash = hash_password(password)
+        for name, _ in machines:
+            stored.append(store_image(name, upload_folder))
+        db.add_conf_images([(name+".squashfs", name, machine_ip, password_hash,
+                             image_blob, pub_blob)
+                            for (name, machine_ip), (image_blob, pub_blob)
+                            in zip(machines, stored)])
+    except:
+        remove_images(built, upload_folder, stored)
+        raise
+
+    keypool.pool.refill()
+    # the zip is built when downloaded, so it never outlives the images
+    return {"images": [name+".squashfs" for name, _ in machines],
+            "pubs": [name+".pub" for name, _ in machines]}
+
+
+def write_keys_zip(file, pubs, upload_folder):
+    # keys of images deleted since the batch are left out
+    with zipfile.ZipFile(file, "w") as archive:
+        for pub in pubs:
+            path = os.path.join(upload_folder, pub)
+            if os.path.exists(path):
+                archive.write(path, pub)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Create many config images at once")
+    parser.add_argument("--prefix", required=True)
+    parser.add_argument("--count", type=int, required=True)
+    parser.add_argument("--ip", required=True, help="VPN address of the first machine")
+    parser.add_argument("--key-length", default="2048")
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--authorized-keys", help="authorized_keys file for root")
+    parser.add_argument("--upload-folder", default="squash")
+    parser.add_argument("--keys", help="zip file for the public keys "
+                        "(default: <first>-<last>-keys.zip)")
+    args = parser.parse_args()
+
+    authorized_keys = None
+    if args.authorized_keys:
+        with open(args.authorized_keys) as authorized_keys_file:
+            authorized_keys = authorized_keys_file.read().strip()
+    result = create_configs_batch(args.prefix, args.count, args.ip,
+                                  args.key_length, args.password,
+                                  authorized_keys, args.upload_folder,
+                                  sys.stdout)
+    keys = args.keys or (result["pubs"][0][:-4] + "-" + result["pubs"][-1][:-4]
+                         + "-keys.zip")
+    write_keys_zip(keys, result["pubs"], args.upload_folder)
+    print(keys)
+
+
+if __name__ == '__main__':
+    main()
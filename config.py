@@ -5,3 +5,42 @@ password = "2a7driUITXFy73tO"
 port = "5432"
 default_file = "default.squashfs"
 webssh_port = "8000"
+# opened by every server process at start, bursts grow the pool up to pool_max_size
+pool_min_size = 2
+pool_max_size = 20
+token_cache_size = 4096
+token_cache_ttl = 300
+probe_mode = "icmp"
+probe_concurrency = 64
+probe_timeout = 1
+probe_port = 22
+log_level = "INFO"
+liveness_mode = "probe"
+heartbeat_flush_interval = 5
+download_offload = None
+x_accel_prefix = "/squash/"
+toolchain_dir = "toolchain"
+job_workers = 2
+job_log_folder = "jobs"
+keypool_folder = "keys"
+keypool_lengths = [2048, 4096]
+keypool_size = 4
+keypool_workers = 4
+build_workers = 4
+batch_max_count = 500
+session_cache_size = 1024
+session_cache_ttl = 60
+session_purge_interval = 3600
+allocation_takeover_timeout = 30
+event_queue_size = 1000
+event_keepalive = 15
+db_trace = False
+slow_query_ms = 100
+slow_query_log = "slow_queries.log"
+run_services_in_app = True
+leader_poll_interval = 5
+overlay_images = True
+rootfs_folder = "rootfs"
+rootfs_scratch = "/var/tmp/rootfs-build"
+apt_cache_dir = "apt-cache"
+boot_retention_days = 30
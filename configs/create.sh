@@ -4,14 +4,15 @@ echo "Parametry podane do skryptu: $@"
 kitcrypto_version="0.0.3"
 uvpn3_version="3.0.4"
 
-usage() { echo "Usage: [-a <root ssh authorized_keys>] [-b add executable to output] [-c <conf file>] [-d <sshd_config>] [-i <ini config>] [-k <pub server key>] [-l <priv key lenght>] [-m <msmtp script>] [-n <name>] [-o <config for msmtp>] [-p <vpn ipaddress>] [-s <scripts folder>]" 1>&2; exit 1; }
+usage() { echo "Usage: [-a <root ssh authorized_keys>] [-b add executable to output] [-B <base image name>] [-c <conf file>] [-d <sshd_config>] [-i <ini config>] [-k <pub server key>] [-l <priv key lenght>] [-m <msmtp script>] [-n <name>] [-o <config for msmtp>] [-O <output folder>] [-p <vpn ipaddress>] [-r <pregenerated priv key>] [-s <scripts folder>] [-S build shared base image] [-t <toolchain cache>]" 1>&2; exit 1; }
 
-while getopts "a:b:c:d:e:i:k:l:m:n:o:p:s:" option
+while getopts "a:b:B:c:d:e:i:k:l:m:n:o:O:p:r:s:St:" option
 do
     case "${option}"
         in
           a)akeys=${OPTARG};;
           b)build="yes";;
+          B)base=${OPTARG};;
           c)conf=${OPTARG};;
           d)sshconf=${OPTARG};;
           i)ini=${OPTARG};;
@@ -20,8 +21,12 @@ do
           m)msmtp=${OPTARG};;
           n)name=${OPTARG};;
           o)msmtp_conf=${OPTARG};;
+          O)out=${OPTARG};;
           p)ip=${OPTARG};;
+          r)privkey=${OPTARG};;
           s)scripts=${OPTARG};;
+          S)shared="yes";;
+          t)toolchain=${OPTARG};;
           *)usage;;
     esac
 done
@@ -30,86 +35,144 @@ shift $((OPTIND-1))
 CONFIGS=$(pwd)
 echo "${CONFIGS}"
 
+if [ -z "$out" ]; then
+  out="$CONFIGS/squash"
+fi
+
 squashfs
 #sudo apt update
 #sudo apt install cmake make g++ gcc libssl-dev libgmp-dev
 
-cd /tmp
-wget -O uVPN.tar.xz https://opensource.krypto-it.pl/uVPN/uVPN-$uvpn3_version.tar.xz
-mkdir uVPN
-tar -xvf uVPN.tar.xz -C uVPN
-rm uVPN.tar.xz
-mv uVPN/*/* uVPN/
-
-wget -O kit-crypto.tar.xz https://opensource.krypto-it.pl/kit-crypto-c/kit-crypto-c-$kitcrypto_version.tar.xz
-mkdir kit-crypto
-tar -xvf kit-crypto.tar.xz -C kit-crypto
-rm kit-crypto.tar.xz
-mv kit-crypto/*/* kit-crypto/
-cd kit-crypto
-cmake .
-make
-
-mkdir ../uVPN.bin
-cd ../uVPN.bin
-cmake ../uVPN -DKIT_CRYPTO_INCLUDES=/tmp/kit-crypto/include -DKIT_CRYPTO_LIB=/tmp/kit-crypto/libkitcryptoc_static.a
-make
-mkdir /tmp/output
-mkdir /tmp/output/vpn
-mkdir /tmp/output/ssh
-./uVPN_rsagen $keylen > /tmp/output/vpn/uVPN.priv
-head -2 /tmp/output/vpn/uVPN.priv > /tmp/output/vpn/"$name.pub"
+if [ -z "$toolchain" ]; then
+  toolchain="$CONFIGS/toolchain"
+fi
+tooldir="$toolchain/uVPN-$uvpn3_version-kit-crypto-$kitcrypto_version"
+
+# uVPN and kit-crypto are built once per version and reused from the cache,
+# tarballs placed in $toolchain are used instead of downloading them
+if [ ! -x "$tooldir/uVPN_rsagen" ]; then
+  mkdir -p "$toolchain"
+  exec 9>"$toolchain/.lock"
+  flock 9
+  if [ ! -x "$tooldir/uVPN_rsagen" ]; then
+    builddir=$(mktemp -d)
+    cd $builddir
+    if [ -f "$toolchain/uVPN-$uvpn3_version.tar.xz" ]; then
+      cp "$toolchain/uVPN-$uvpn3_version.tar.xz" uVPN.tar.xz
+    else
+      wget -O uVPN.tar.xz https://opensource.krypto-it.pl/uVPN/uVPN-$uvpn3_version.tar.xz
+    fi
+    mkdir uVPN
+    tar -xvf uVPN.tar.xz -C uVPN
+    rm uVPN.tar.xz
+    mv uVPN/*/* uVPN/
+
+    if [ -f "$toolchain/kit-crypto-c-$kitcrypto_version.tar.xz" ]; then
+      cp "$toolchain/kit-crypto-c-$kitcrypto_version.tar.xz" kit-crypto.tar.xz
+    else
+      wget -O kit-crypto.tar.xz https://opensource.krypto-it.pl/kit-crypto-c/kit-crypto-c-$kitcrypto_version.tar.xz
+    fi
+    mkdir kit-crypto
+    tar -xvf kit-crypto.tar.xz -C kit-crypto
+    rm kit-crypto.tar.xz
+    mv kit-crypto/*/* kit-crypto/
+    cd kit-crypto
+    cmake .
+    make
+
+    mkdir ../uVPN.bin
+    cd ../uVPN.bin
+    cmake ../uVPN -DKIT_CRYPTO_INCLUDES=$builddir/kit-crypto/include -DKIT_CRYPTO_LIB=$builddir/kit-crypto/libkitcryptoc_static.a
+    make
+    mkdir $builddir/bin
+    cp uVPN_rsagen uVPN3 $builddir/bin
+    rm -rf "$tooldir"
+    mv $builddir/bin "$tooldir"
+    cd $CONFIGS
+    rm -rf $builddir
+  fi
+  flock -u 9
+fi
+
+# -S builds the base image with the files shared by all machines, -B builds
+# only the per-machine files, init stacks them on top of the named base
+output=$(mktemp -d)
+chmod 755 $output
+mkdir $output/vpn
+mkdir $output/ssh
+if [ -z "$shared" ]; then
+  if [ -n "$privkey" ]; then
+    cp $privkey $output/vpn/uVPN.priv
+  else
+    "$tooldir/uVPN_rsagen" $keylen > $output/vpn/uVPN.priv
+  fi
+  head -2 $output/vpn/uVPN.priv > $output/vpn/"$name.pub"
+fi
 
 if [ -n "$build" ]; then
-  mv uVPN3 /tmp/output/vpn
+  cp "$tooldir/uVPN3" $output/vpn
 fi
 
 cd $CONFIGS
-cp $conf /tmp/output/vpn
-cp $ini /tmp/output/vpn
-cp $key /tmp/output/vpn
+if [ -z "$shared" ]; then
+  cp $conf $output/vpn
+  cp $ini $output/vpn
+fi
 
 if [ -n "$akeys" ]; then
-  cp $akeys /tmp/output/ssh
+  cp $akeys $output/ssh
 fi
 
-if [ -n "$sshconf" ]; then
-  cp $sshconf /tmp/output/ssh
-fi
+if [ -z "$base" ]; then
+  cp $key $output/vpn
 
-mkdir /tmp/output/msmtp
-if [ -n "$msmtp" ]; then
-  cp $msmtp /tmp/output/msmtp
-fi
+  if [ -n "$sshconf" ]; then
+    cp $sshconf $output/ssh
+  fi
+
+  mkdir $output/msmtp
+  if [ -n "$msmtp" ]; then
+    cp $msmtp $output/msmtp
+  fi
 
-if [ -n "$msmtp_conf" ]; then
-  cp $msmtp_conf /tmp/output/msmtp
+  if [ -n "$msmtp_conf" ]; then
+    cp $msmtp_conf $output/msmtp
+  fi
 fi
 
 if [ -n "$scripts" ]; then
-  mkdir /tmp/output/vpn/scripts
-  cp -r $scripts/* /tmp/output/vpn/scripts
+  mkdir $output/vpn/scripts
+  if [ -n "$base" ]; then
+    cp $scripts/starttap.sh $output/vpn/scripts
+  else
+    cp -r $scripts/* $output/vpn/scripts
+  fi
 fi
 
-ls /tmp/output/vpn/scripts
-ls /tmp/output/vpn/
+ls $output/vpn/scripts
+ls $output/vpn/
 
-sed -i 's/ip/'"$ip"'/g' /tmp/output/vpn/scripts/starttap.sh
-sed -i '/^private_key/c\private_key uVPN.priv' /tmp/output/vpn/$(basename "$conf")
-sed -i '/^tap_name/c\tap_name uvpnT2' /tmp/output/vpn/$(basename "$conf")
-sed -i '/^name/c\name '"$name" /tmp/output/vpn/$(basename "$conf")
-sed -i '/^servers_config/c\servers_config '"$(basename "$ini")" /tmp/output/vpn/$(basename "$conf")
-sed -i '1s/.*/['"$name"']/' /tmp/output/vpn/$(basename "$ini")
+if [ -z "$shared" ]; then
+  sed -i 's/ip/'"$ip"'/g' $output/vpn/scripts/starttap.sh
+  sed -i '/^private_key/c\private_key uVPN.priv' $output/vpn/$(basename "$conf")
+  sed -i '/^tap_name/c\tap_name uvpnT2' $output/vpn/$(basename "$conf")
+  sed -i '/^name/c\name '"$name" $output/vpn/$(basename "$conf")
+  sed -i '/^servers_config/c\servers_config '"$(basename "$ini")" $output/vpn/$(basename "$conf")
+  sed -i '1s/.*/['"$name"']/' $output/vpn/$(basename "$ini")
+fi
 
-cd /tmp/output
+cd $output
 mkdir configs
 mv * configs
-mkdir "$CONFIGS/squash"
-mksquashfs . $CONFIGS/squash/"$name.squashfs"
-cp /tmp/output/configs/vpn/"$name.pub" $CONFIGS/squash/"$name.pub"
+if [ -n "$base" ]; then
+  echo "$base" > configs/base
+fi
+mkdir -p "$out"
+mksquashfs . "$out/$name.squashfs" -noappend
+if [ -z "$shared" ]; then
+  cp $output/configs/vpn/"$name.pub" "$out/$name.pub"
+fi
 
 echo "$name"
 
-rm -rf /tmp/kit-crypto
-rm -rf /tmp/uVPN*
-rm -rf /tmp/output
+rm -rf $output
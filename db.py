@@ -1,75 +1,199 @@
+import json
+import threading
+from contextlib import contextmanager
+from functools import wraps
 import psycopg2
+from psycopg2 import pool
+from psycopg2.extras import Json
 import config
 import utils
 import machines
 import images
+import fleet
+import cache
+import migrations
+import metrics
+import tracing
+
+
+connection_pool = None
+pool_lock = threading.Lock()
+pool_slots = None
+# connections checked out and kept open by the pool, counted here rather
+# than read from the pool's private attributes
+pool_counts = {"used": 0, "idle": 0}
+pool_counts_lock = threading.Lock()
+token_cache = cache.TTLCache(config.token_cache_size, config.token_cache_ttl)
+session_cache = cache.TTLCache(config.session_cache_size, config.session_cache_ttl)
+INVALIDATE_CHANNEL = "cache_invalidate"
+EVENT_CHANNEL = "machine_events"
+# NOTIFY payloads are limited to 8000 bytes
+INVALIDATE_BATCH = 50
+# pg_advisory_xact_lock key taken while reserving image names for a job
+RESERVE_LOCK = 7164003
+
+
+def pool_usage():
+    if connection_pool is None:
+        return {}
+    with pool_counts_lock:
+        return {("used",): pool_counts["used"],
+                ("idle",): pool_counts["idle"],
+                ("max",): config.pool_max_size}
+
+
+def cache_lookups():
+    values = {}
+    for name, lookup_cache in (("token", token_cache), ("session", session_cache)):
+        stats = lookup_cache.stats()
+        values[(name, "hit")] = stats["hits"]
+        values[(name, "miss")] = stats["misses"]
+    return values
+
+
+metrics.Callback("db_pool_connections", "Pooled database connections by state",
+                 ("state",), "gauge", pool_usage)
+metrics.Callback("cache_lookups_total", "Token and session cache lookups",
+                 ("cache", "result"), "counter", cache_lookups)
+
+
+def timed(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with metrics.db_query_seconds.time(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
 
 
 def connect():
-    global cur, conn
+    global connection_pool, pool_slots
+    with pool_lock:
+        if connection_pool is not None:
+            return connection_pool
+        try:
+            connection_pool = pool.ThreadedConnectionPool(
+                config.pool_min_size, config.pool_max_size,
+                database=config.database,
+                host=config.host,
+                user=config.user,
+                password=config.password,
+                port=config.port,
+                options="-c timezone=UTC",
+                cursor_factory=tracing.TracingCursor if config.db_trace else None)
+        except Exception as ex:
+            print(f"Error connecting to PostgreSQL: {ex}")
+            raise
+        pool_slots = threading.BoundedSemaphore(config.pool_max_size)
+        with pool_counts_lock:
+            # the pool opens pool_min_size connections up front
+            pool_counts.update(used=0, idle=config.pool_min_size)
+        try:
+            migrate()
+        except:
+            # the next connect() retries the migration instead of using
+            # a pool against an unmigrated schema
+            connection_pool.closeall()
+            connection_pool = None
+            with pool_counts_lock:
+                pool_counts.update(used=0, idle=0)
+            raise
+    return connection_pool
+
+
+def dedicated_connection():
+    # outside the pool, for sessions that must outlive a single request
+    conn = psycopg2.connect(database=config.database, host=config.host,
+                            user=config.user, password=config.password,
+                            port=config.port, keepalives=1,
+                            keepalives_idle=10, keepalives_interval=5,
+                            keepalives_count=3)
+    conn.autocommit = True
+    return conn
+
+
+def migrate():
+    conn = take_conn(connection_pool)
     try:
-        conn = psycopg2.connect(database=config.database,
-                                host=config.host,
-                                user=config.user,
-                                password=config.password,
-                                port=config.port)
-    except Exception as ex:
-        print(f"Error connecting to PostgreSQL: {ex}")
-
-    cur = conn.cursor()
-
-    with conn.cursor() as cur:
-        cur.execute("SET TIMEZONE = 'UTC';")
-        conn.commit()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS image (
-                id SERIAL PRIMARY KEY,
-                image_name VARCHAR(255) NOT NULL,
-                token VARCHAR(255) NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                password VARCHAR(128) NOT NULL,
-                vpn_ip INET
-            );""")
-        conn.commit()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(50) UNIQUE NOT NULL,
-                password VARCHAR(256) NOT NULL,
-                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
-            );""")
-        conn.commit()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS auth_tokens (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL REFERENCES users(id),
-                token VARCHAR(64) NOT NULL,
-                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                expires_on TIMESTAMP NOT NULL
-            );""")
-        conn.commit()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS image_allocation (
-                id SERIAL PRIMARY KEY,
-                image_id INTEGER NOT NULL REFERENCES image(id),
-                allocation_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                last_access_time TIMESTAMP,
-                client_ip_local INET,
-                client_ip_vpn INET
-            );""")
-        conn.commit()
+        migrations.migrate(conn)
+    finally:
+        put_conn(connection_pool, conn)
 
 
-def get_cur():
-    return conn.cursor()
+def take_conn(conn_pool):
+    conn = conn_pool.getconn()
+    with pool_counts_lock:
+        # getconn reuses an idle connection before opening a new one
+        pool_counts["idle"] = max(pool_counts["idle"] - 1, 0)
+        pool_counts["used"] += 1
+    return conn
+
 
+def put_conn(conn_pool, conn, close=False):
+    # connections beyond pool_min_size are closed by putconn
+    conn_pool.putconn(conn, close=close)
+    with pool_counts_lock:
+        pool_counts["used"] -= 1
+        if not conn.closed:
+            pool_counts["idle"] += 1
 
+
+@contextmanager
 def get_conn():
-    return conn
+    conn_pool = connection_pool or connect()
+    metrics.db_pool_waiting.inc()
+    try:
+        pool_slots.acquire()
+    finally:
+        metrics.db_pool_waiting.dec()
+    conn = take_conn(conn_pool)
+    try:
+        yield conn
+        conn.commit()
+    except:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        put_conn(conn_pool, conn, close=bool(conn.closed))
+        pool_slots.release()
+
+
+@contextmanager
+def get_cur():
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+
+def notify_invalidate(cur, kind, keys):
+    # delivered to every node's listener when the transaction commits
+    keys = list(keys)
+    for i in range(0, len(keys), INVALIDATE_BATCH):
+        cur.execute("SELECT pg_notify(%s, %s)", (
+            INVALIDATE_CHANNEL,
+            json.dumps({"cache": kind, "keys": keys[i:i + INVALIDATE_BATCH]}),))
+
+
+@timed
+def relay_events(batch):
+    # lists of names are split like invalidation keys to fit a payload
+    payloads = []
+    for kind, data in batch:
+        names = data.get("names")
+        if names is None:
+            payloads.append(json.dumps({"kind": kind, "data": data}, default=str))
+            continue
+        for i in range(0, len(names), INVALIDATE_BATCH):
+            payloads.append(json.dumps(
+                {"kind": kind, "data": dict(data, names=names[i:i + INVALIDATE_BATCH])},
+                default=str))
+    with get_cur() as cur:
+        cur.execute("""
+            SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload
+        """, (EVENT_CHANNEL, payloads,))
 
 
 def get_one(sql, value):
-    connect()
     with get_cur() as cur:
         cur.execute(sql, (value,))
         try:
@@ -78,48 +202,136 @@ def get_one(sql, value):
             return None
 
 
-def add_conf_image(name, token, ip, password):
-    connect()
+def ref_blobs(cur, blobs):
+    counts = {}
+    for digest, size in blobs:
+        counts[digest] = (size, counts.get(digest, (size, 0))[1] + 1)
+    tracing.execute_values(cur, """
+        INSERT INTO blob (digest, size, refcount) VALUES %s
+        ON CONFLICT (digest) DO UPDATE SET refcount = blob.refcount + EXCLUDED.refcount
+    """, [(digest, size, count) for digest, (size, count) in counts.items()])
+
+
+def unref_blobs(cur, digests):
+    # returns the digests no image refers to any more
+    cur.execute("""
+        UPDATE blob SET refcount = refcount - 1 WHERE digest = ANY(%s)
+    """, (digests,))
+    cur.execute("""
+        DELETE FROM blob WHERE digest = ANY(%s) AND refcount <= 0
+        RETURNING digest
+    """, (digests,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def blob_digest(blob):
+    return blob[0] if blob else None
+
+
+@timed
+def add_conf_image(name, token, ip, password, image_blob=None, pub_blob=None):
     with get_cur() as cur:
+        blobs = [blob for blob in (image_blob, pub_blob) if blob]
+        if blobs:
+            ref_blobs(cur, blobs)
         cur.execute("""
-            INSERT INTO image (image_name, token, vpn_ip, password)
-            VALUES (%s, %s, %s, %s)
-        """, (name, token, ip, password, ))
-        conn.commit()
+            INSERT INTO image (image_name, token, vpn_ip, password,
+                               image_digest, pub_digest)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """, (name, token, ip, password, blob_digest(image_blob),
+              blob_digest(pub_blob), ))
+        image_id = cur.fetchone()[0]
+        notify_invalidate(cur, "token", [token])
+        notify_invalidate(cur, "image", [name])
+        notify_invalidate(cur, "fleet", [image_id])
+    token_cache.invalidate(token)
+    fleet.changed([image_id])
+
+
+@timed
+def add_conf_images(rows):
+    # rows of (name, token, ip, password, image_blob, pub_blob)
+    with get_cur() as cur:
+        blobs = [blob for row in rows for blob in row[4:] if blob]
+        if blobs:
+            ref_blobs(cur, blobs)
+        image_ids = [row[0] for row in tracing.execute_values(cur, """
+            INSERT INTO image (image_name, token, vpn_ip, password,
+                               image_digest, pub_digest)
+            VALUES %s
+            RETURNING id
+        """, [(name, token, ip, password, blob_digest(image_blob),
+               blob_digest(pub_blob))
+              for name, token, ip, password, image_blob, pub_blob in rows],
+            fetch=True)]
+        notify_invalidate(cur, "token", [row[1] for row in rows])
+        notify_invalidate(cur, "image", [row[0] for row in rows])
+        notify_invalidate(cur, "fleet", image_ids)
+    for row in rows:
+        token_cache.invalidate(row[1])
+    fleet.changed(image_ids)
+
+
+def get_conf_by_token(token):
+    image = token_cache.get(token)
+    if image is not None:
+        return image
+    with metrics.db_query_seconds.time("get_conf_by_token"), get_cur() as cur:
+        cur.execute("""
+            SELECT id, token, image_name, vpn_ip, password
+            FROM image WHERE token = %s""", (token,))
+        row = cur.fetchone()
+    if row is None:
+        return None
+    image = images.Image(id=row[0], token=row[1], name=row[2],
+                         vpn_ip=row[3], password=row[4])
+    token_cache.set(token, image)
+    return image
 
 
 def get_conf_image(token):
-    return get_one("SELECT image_name FROM image WHERE token = %s", token)
+    image = get_conf_by_token(token)
+    if image is None:
+        return None
+    return image.name
 
 
 def get_conf_password(token):
-    return get_one("SELECT password FROM image WHERE token = %s", token)
+    image = get_conf_by_token(token)
+    if image is None:
+        return None
+    return image.password
 
 
+@timed
 def get_conf_image_id(id):
     return get_one("SELECT image_name FROM image WHERE id = %s", id)
 
 
 def get_conf_id(token):
-    return get_one("SELECT id FROM image WHERE token = %s", token)
+    image = get_conf_by_token(token)
+    if image is None:
+        return None
+    return image.id
 
 
+@timed
 def get_conf_id_name(name):
     return get_one("SELECT id FROM image WHERE image_name = %s", name)
 
 
+@timed
 def add_user(username, password):
-    connect()
     with get_cur() as cur:
         cur.execute("""
             INSERT INTO users (username, password)
             VALUES (%s, %s)
         """, (username, utils.hash_password(password),))
-        conn.commit()
 
 
+@timed
 def get_user_pass(username, password):
-    connect()
     with get_cur() as cur:
         cur.execute("""
             SELECT id FROM users WHERE username = %s AND password = %s
@@ -130,35 +342,61 @@ def get_user_pass(username, password):
             return None
 
 
+@timed
 def get_user_byid(id):
     return get_one("SELECT id FROM users WHERE id = %s", id)
 
 
 def get_user_bytoken(token):
-    return get_one("SELECT user_id FROM auth_tokens WHERE token = %s", token)
+    if not token:
+        return None
+    user_id = session_cache.get(token)
+    if user_id is not None:
+        return user_id
+    with metrics.db_query_seconds.time("get_user_bytoken"), get_cur() as cur:
+        cur.execute("""
+            SELECT user_id, EXTRACT(EPOCH FROM expires_on - CURRENT_TIMESTAMP)
+            FROM auth_tokens
+            WHERE token = %s AND expires_on > CURRENT_TIMESTAMP
+        """, (token,))
+        row = cur.fetchone()
+    if row is None:
+        return None
+    session_cache.set(token, row[0],
+                      ttl=min(config.session_cache_ttl, float(row[1])))
+    return row[0]
 
 
+@timed
 def add_auth_token(user_id):
     token = utils.generate_auth_token()
-    connect()
     with get_cur() as cur:
         cur.execute("""
             INSERT INTO auth_tokens (user_id, token, expires_on)
             VALUES (%s, %s, CURRENT_TIMESTAMP + INTERVAL '1 day')
         """, (user_id, token,))
-        conn.commit()
     return token
 
 
+@timed
 def del_auth_token(token):
-    connect()
+    try:
+        with get_cur() as cur:
+            cur.execute("DELETE FROM auth_tokens WHERE token = %s", (token, ))
+            notify_invalidate(cur, "session", [token])
+        return True
+    except:
+        return None
+    finally:
+        session_cache.invalidate(token)
+
+
+@timed
+def purge_auth_tokens():
     with get_cur() as cur:
-        cur.execute("DELETE FROM auth_tokens WHERE token = %s", (token, ))
-        try:
-            conn.commit()
-            return True
-        except:
-            return None
+        cur.execute(
+            "DELETE FROM auth_tokens WHERE expires_on <= CURRENT_TIMESTAMP")
+        return cur.rowcount
 
 
 def login(username, password):
@@ -169,172 +407,372 @@ def login(username, password):
         return None
 
 
-def get_machines():
-    connect()
+@timed
+def get_fleet(image_ids=None):
+    # images with their allocation, if any, as (Image, Machine or None)
+    sql = """
+        SELECT i.id, i.token, i.image_name, i.vpn_ip,
+               a.id, a.allocation_time, a.client_ip_vpn, a.client_ip_local
+        FROM image i LEFT JOIN image_allocation a ON a.image_id = i.id"""
+    params = []
+    if image_ids is not None:
+        sql += " WHERE i.id = ANY(%s)"
+        params.append(list(image_ids))
     with get_cur() as cur:
-        cur.execute("""
-            SELECT image_id, allocation_time, client_ip_vpn,
-                   client_ip_local FROM image_allocation""")
-        try:
-            machinesall = machines.MachineManager()
-            for row in cur.fetchall():
-                token = get_one(
-                    "SELECT token FROM image WHERE id = %s", row[0])
-                image_name = get_one(
-                    "SELECT image_name FROM image WHERE id = %s", row[0])
+        cur.execute(sql, params)
+        rows = []
+        for row in cur.fetchall():
+            image = images.Image(id=row[0], token=row[1], name=row[2],
+                                 vpn_ip=row[3])
+            machine = None
+            if row[4] is not None:
                 machine = machines.Machine(
-                    token, image_name, start_time=row[1], ipvpn=row[2],
-                    iplocal=row[3], username="root", password="")
-                machinesall.add_machine(machine)
-            return machinesall
-        except:
-            return None
+                    row[1], row[2], start_time=row[5], ipvpn=row[6],
+                    iplocal=row[7], username="root", password="", id=row[4],
+                    image_id=row[0])
+            rows.append((image, machine))
+        return rows
 
 
-def get_images():
-    connect()
-    with get_cur() as cur:
-        cur.execute("""
-            SELECT id, token, image_name, vpn_ip FROM image""")
-        try:
-            images_all = images.ImageManager()
-            for row in cur.fetchall():
-                image = images.Image(
-                    id=row[0], token=row[1], name=row[2], vpn_ip=row[3])
-                images_all.add_image(image)
-            return images_all
-        except:
-            return None
+@timed
+def del_image(image_id):
+    # returns the blobs left without any image, their files can be removed
+    try:
+        unreferenced = []
+        with get_cur() as cur:
+            cur.execute("""
+                DELETE FROM image WHERE id = %s
+                RETURNING token, image_name, image_digest, pub_digest
+            """, (image_id,))
+            row = cur.fetchone()
+            if row is not None:
+                notify_invalidate(cur, "token", [row[0]])
+                notify_invalidate(cur, "image", [row[1]])
+                notify_invalidate(cur, "fleet", [image_id])
+                digests = [digest for digest in row[2:] if digest]
+                if digests:
+                    unreferenced = unref_blobs(cur, digests)
+        if row is not None:
+            token_cache.invalidate(row[0])
+            fleet.changed([image_id])
+        return unreferenced
+    except:
+        return None
 
 
-def del_image(image_id):
-    connect()
+@timed
+def get_images_without_blobs():
     with get_cur() as cur:
-        cur.execute("DELETE FROM image WHERE id = %s", (image_id,))
-        try:
-            conn.commit()
-            return True
-        except:
-            return None
+        cur.execute("SELECT id, image_name FROM image WHERE image_digest IS NULL")
+        return cur.fetchall()
 
 
-def get_image_allocation_all_id():
-    connect()
+@timed
+def set_image_blobs(image_id, image_blob, pub_blob):
     with get_cur() as cur:
+        ref_blobs(cur, [blob for blob in (image_blob, pub_blob) if blob])
         cur.execute("""
-            SELECT id FROM image_allocation""")
-        try:
-            results = [list(row) for row in cur.fetchall()]
-            return results
-        except:
-            return None
+            UPDATE image SET image_digest = %s, pub_digest = %s WHERE id = %s
+        """, (blob_digest(image_blob), blob_digest(pub_blob), image_id,))
 
 
-def get_image_allocation_all():
-    connect()
+@timed
+def get_blob_digests():
     with get_cur() as cur:
-        cur.execute("""
-            SELECT * FROM image_allocation""")
-        try:
-            results = [list(row) for row in cur.fetchall()]
-            return results
-        except:
-            return None
+        cur.execute("SELECT digest FROM blob")
+        return [row[0] for row in cur.fetchall()]
 
 
+@timed
 def get_image_allocation(image_id):
     return get_one("SELECT id FROM image_allocation WHERE image_id = %s", image_id)
 
 
-def get_image_allocation_time(token):
-    image_id = get_conf_id(token)
-    if image_id is None:
+@timed
+def allocate_image(token, client_ip, takeover_timeout):
+    # new allocation, or takeover of one not seen for takeover_timeout
+    # seconds, returns (image_name, image_digest); a fresh allocation
+    # returns no row and gets the default image
+    with get_cur() as cur:
+        cur.execute("""
+            WITH img AS (
+                SELECT id, image_name, image_digest FROM image WHERE token = %s
+            ), allocated AS (
+                INSERT INTO image_allocation
+                    (image_id, client_ip_local, last_access_time)
+                SELECT id, %s, CURRENT_TIMESTAMP FROM img
+                ON CONFLICT (image_id) DO UPDATE
+                SET allocation_time = CURRENT_TIMESTAMP,
+                    last_access_time = CURRENT_TIMESTAMP,
+                    client_ip_local = EXCLUDED.client_ip_local,
+                    client_ip_vpn = NULL
+                WHERE image_allocation.last_access_time IS NULL
+                   OR image_allocation.last_access_time
+                      < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+                RETURNING image_id, allocation_time
+            ), booted AS (
+                INSERT INTO boot (image_id, started_at)
+                SELECT image_id, allocation_time FROM allocated
+            )
+            SELECT img.image_name, img.image_digest, img.id
+            FROM img JOIN allocated ON allocated.image_id = img.id
+        """, (token, client_ip, takeover_timeout,))
+        row = cur.fetchone()
+        if row is not None:
+            notify_invalidate(cur, "fleet", [row[2]])
+    if row is None:
         return None
-    return get_one("SELECT last_access_time FROM image_allocation WHERE image_id = %s", image_id)
+    fleet.changed([row[2]])
+    return row[0], row[1]
 
 
-def get_image_allocation_time_id(id):
-    return get_one("SELECT last_access_time FROM image_allocation WHERE id = %s", id)
+@timed
+def release_allocation(image_id):
+    with get_cur() as cur:
+        cur.execute("""
+            DELETE FROM image_allocation a USING image i
+            WHERE a.image_id = %s AND i.id = a.image_id
+            RETURNING i.token
+        """, (image_id,))
+        row = cur.fetchone()
+        if row is not None:
+            notify_invalidate(cur, "fleet", [image_id])
+    if row is None:
+        return None
+    fleet.changed([image_id])
+    return row[0]
 
 
-def get_image_allocation_clientip(token):
-    id_image = get_conf_id(token)
-    if id_image is None:
+def del_image_allocation(sql, value):
+    # sql ends with RETURNING image_id
+    try:
+        with get_cur() as cur:
+            cur.execute(sql, (value, ))
+            image_ids = [row[0] for row in cur.fetchall()]
+            notify_invalidate(cur, "fleet", image_ids)
+        fleet.changed(image_ids)
+        return True
+    except:
         return None
 
-    return get_one("SELECT last_access_time FROM image_allocation WHERE id = %s", id_image)
 
+@timed
+def del_image_allocation_id_image(image_id):
+    return del_image_allocation("DELETE FROM image_allocation WHERE image_id = %s RETURNING image_id", image_id)
 
-def get_image_allocation_clientip_id_vpn(id):
-    return get_one("SELECT client_ip_vpn FROM image_allocation WHERE id = %s", id)
 
+@timed
+def apply_allocation_sweep(alive_ids, expired_ids, timeout):
+    updated = 0
+    deleted = []
+    if not alive_ids and not expired_ids:
+        return updated, deleted
+    with get_cur() as cur:
+        if alive_ids:
+            cur.execute("""
+                UPDATE image_allocation SET last_access_time = CURRENT_TIMESTAMP
+                WHERE id = ANY(%s)
+            """, (alive_ids,))
+            updated = cur.rowcount
+        if expired_ids:
+            cur.execute("""
+                DELETE FROM image_allocation
+                WHERE id = ANY(%s)
+                  AND last_access_time < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+                RETURNING id, image_id
+            """, (expired_ids, timeout,))
+            rows = cur.fetchall()
+            deleted = [row[0] for row in rows]
+            image_ids = [row[1] for row in rows]
+            notify_invalidate(cur, "fleet", image_ids)
+    if expired_ids:
+        fleet.changed(image_ids)
+    return updated, deleted
+
+
+@timed
+def update_image_allocation_heartbeats(heartbeats):
+    # heartbeats maps image_id to seconds since the last one
+    with get_cur() as cur:
+        cur.execute("""
+            UPDATE image_allocation a
+            SET last_access_time = GREATEST(a.last_access_time,
+                                            CURRENT_TIMESTAMP - h.age * INTERVAL '1 second')
+            FROM unnest(%s::integer[], %s::float8[]) AS h(image_id, age)
+            WHERE a.image_id = h.image_id
+        """, (list(heartbeats.keys()), list(heartbeats.values()),))
+        return cur.rowcount
+
+
+@timed
+def add_boot_events(events):
+    # events maps (image_id, phase) to seconds since it happened, so times
+    # come from the same clock as boot.started_at; only the first occurrence
+    # of a phase is kept, on the latest boot that started before it
+    keys = list(events.keys())
+    with get_cur() as cur:
+        cur.execute("""
+            WITH e AS (
+                SELECT image_id, phase,
+                       CURRENT_TIMESTAMP - MAX(age) * INTERVAL '1 second' AS at
+                FROM unnest(%s::integer[], %s::text[], %s::float8[])
+                     AS e(image_id, phase, age)
+                GROUP BY image_id, phase
+            ), latest AS (
+                SELECT DISTINCT ON (b.image_id) b.id, b.image_id, b.started_at, b.events
+                FROM boot b WHERE b.image_id IN (SELECT image_id FROM e)
+                ORDER BY b.image_id, b.started_at DESC
+            ), new AS (
+                SELECT l.id, jsonb_object_agg(e.phase, round(
+                    EXTRACT(EPOCH FROM e.at - l.started_at)::numeric, 3)) AS events
+                FROM latest l JOIN e ON e.image_id = l.image_id
+                WHERE e.at >= l.started_at AND NOT l.events ? e.phase
+                GROUP BY l.id
+            )
+            UPDATE boot b SET events = new.events || b.events
+            FROM new WHERE b.id = new.id
+        """, ([image_id for image_id, _ in keys], [phase for _, phase in keys],
+              list(events.values()),))
+        return cur.rowcount
+
+
+@timed
+def mark_boots_seen():
+    # the first liveness signal after getconf moves last_access_time past
+    # allocation_time, whether it came from a probe, a heartbeat or addip
+    with get_cur() as cur:
+        cur.execute("""
+            UPDATE boot b SET events = b.events || jsonb_build_object('seen', round(
+                EXTRACT(EPOCH FROM a.last_access_time - b.started_at)::numeric, 3))
+            FROM image_allocation a
+            WHERE a.image_id = b.image_id AND b.started_at = a.allocation_time
+              AND a.last_access_time > a.allocation_time
+              AND NOT b.events ? 'seen'
+        """)
+        return cur.rowcount
+
+
+@timed
+def get_boots(limit, hours):
+    with get_cur() as cur:
+        cur.execute("""
+            SELECT b.id, i.token, b.started_at, b.events
+            FROM boot b JOIN image i ON i.id = b.image_id
+            WHERE b.started_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'
+            ORDER BY b.started_at DESC LIMIT %s
+        """, (hours, limit,))
+        return [{"id": row[0], "token": row[1], "started_at": row[2],
+                 "events": row[3]} for row in cur.fetchall()]
 
-def set_image_allocation(token, client_ip):
-    id_image = get_conf_id(token)
-    if id_image is None:
-        return None
 
-    connect()
+@timed
+def get_boot_stats(hours):
     with get_cur() as cur:
         cur.execute("""
-            INSERT INTO image_allocation (image_id, client_ip_local, last_access_time)
-            VALUES (%s, %s, CURRENT_TIMESTAMP)
-        """, (id_image, client_ip,))
-        conn.commit()
-    return token
+            SELECT e.key, COUNT(*),
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY e.value::float),
+                   percentile_cont(0.9) WITHIN GROUP (ORDER BY e.value::float),
+                   percentile_cont(0.99) WITHIN GROUP (ORDER BY e.value::float),
+                   MAX(e.value::float)
+            FROM boot b, jsonb_each_text(b.events) e
+            WHERE b.started_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'
+            GROUP BY e.key
+            ORDER BY 3
+        """, (hours,))
+        return [{"phase": row[0], "count": row[1], "p50": row[2], "p90": row[3],
+                 "p99": row[4], "max": row[5]} for row in cur.fetchall()]
+
+
+@timed
+def purge_boots(days):
+    with get_cur() as cur:
+        cur.execute("""
+            DELETE FROM boot WHERE started_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+        """, (days,))
+        return cur.rowcount
 
 
-def del_image_allocation_token(token):
-    id_image = get_conf_id(token)
-    if id_image is None:
+@timed
+def update_image_allocation_ip_vpn(token, ip):
+    image_id = fleet.get_image_id_by_token(token)
+    if image_id is None:
+        return None
+    try:
+        with get_cur() as cur:
+            cur.execute("""
+                UPDATE image_allocation SET client_ip_vpn = %s WHERE image_id = %s 
+            """, (ip, image_id,))
+            notify_invalidate(cur, "fleet", [image_id])
+        fleet.changed([image_id])
+        return True
+    except:
         return None
-
-    return del_image_allocation_id_image(id_image)
 
 
-def del_image_allocation(sql, value):
-    connect()
+@timed
+def add_job(kind, params, worker, reserve=None):
     with get_cur() as cur:
-        cur.execute(sql, (value, ))
-        try:
-            conn.commit()
-            return True
-        except:
-            return None
+        if reserve is not None:
+            image_names, tokens = reserve
+            # serializes reservations, the images themselves are only
+            # inserted when the job finishes
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (RESERVE_LOCK,))
+            cur.execute("""
+                SELECT EXISTS (SELECT 1 FROM image
+                               WHERE image_name = ANY(%s) OR token = ANY(%s))
+                    OR EXISTS (SELECT 1 FROM jobs
+                               WHERE status IN ('queued', 'running')
+                                 AND (params->'reserved'->'images' ?| %s
+                                      OR params->'reserved'->'tokens' ?| %s))
+            """, (image_names, tokens, image_names, tokens,))
+            if cur.fetchone()[0]:
+                return None
+            params = dict(params, reserved={"images": image_names, "tokens": tokens})
+        cur.execute("""
+            INSERT INTO jobs (kind, params, worker)
+            VALUES (%s, %s, %s) RETURNING id
+        """, (kind, Json(params), worker,))
+        return cur.fetchone()[0]
 
 
-def del_image_allocation_id_image(image_id):
-    return del_image_allocation("DELETE FROM image_allocation WHERE image_id = %s", image_id)
+@timed
+def start_job(job_id):
+    with get_cur() as cur:
+        cur.execute("""
+            UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        """, (job_id,))
 
 
-def del_image_allocation_id(id):
-    return del_image_allocation("DELETE FROM image_allocation WHERE id = %s", id)
+@timed
+def finish_job(job_id, status, result, log):
+    with get_cur() as cur:
+        cur.execute("""
+            UPDATE jobs SET status = %s, result = %s, log = %s,
+                            finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        """, (status, Json(result), log, job_id,))
 
 
-def update_image_allocation_time(id):
-    connect()
+@timed
+def get_job(job_id):
     with get_cur() as cur:
         cur.execute("""
-            UPDATE image_allocation SET last_access_time = CURRENT_TIMESTAMP WHERE id = %s 
-        """, (id,))
-        try:
-            conn.commit()
-            return True
-        except:
-            return None
+            SELECT id, kind, status, params, result, log,
+                   created_at, started_at, finished_at
+            FROM jobs WHERE id = %s""", (job_id,))
+        row = cur.fetchone()
+    if row is None:
+        return None
+    keys = ("id", "kind", "status", "params", "result", "log",
+            "created_at", "started_at", "finished_at")
+    return dict(zip(keys, row))
 
 
-def update_image_allocation_ip_vpn(token, ip):
-    image_id = get_conf_id(token)
-    if image_id is None:
-        return None
-    connect()
+@timed
+def get_unfinished_jobs():
     with get_cur() as cur:
         cur.execute("""
-            UPDATE image_allocation SET client_ip_vpn = %s WHERE image_id = %s 
-        """, (ip, image_id,))
-        try:
-            conn.commit()
-            return True
-        except:
-            return None
+            SELECT id, worker FROM jobs
+            WHERE status IN ('queued', 'running') AND worker IS NOT NULL""")
+        return cur.fetchall()
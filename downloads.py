@@ -0,0 +1,77 @@
+import os
+import threading
+from flask import make_response, request, send_file
+import config
+import metrics
+import store
+
+etag_cache = {}
+etag_lock = threading.Lock()
+
+
+def file_etag(path):
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with etag_lock:
+        cached = etag_cache.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    etag = store.hash_file(path)
+    with etag_lock:
+        etag_cache[path] = (version, etag)
+    return etag
+
+
+def invalidate_etag(path):
+    with etag_lock:
+        etag_cache.pop(path, None)
+
+
+def invalidate_image(filename):
+    with etag_lock:
+        for path in [path for path in etag_cache if os.path.basename(path) == filename]:
+            del etag_cache[path]
+
+
+def clear_etags():
+    with etag_lock:
+        etag_cache.clear()
+
+
+def send_image(folder, filename, shared=False, digest=None):
+    # digest is the SHA-256 recorded when the image was built, only images
+    # without one are hashed here
+    path = os.path.join(folder, filename)
+    etag = digest or file_etag(path)
+    if config.download_offload is None:
+        response = send_file(path, etag=etag, conditional=True)
+    else:
+        # the frontend server streams the body and handles Range itself
+        response = make_response("")
+        response.mimetype = "application/octet-stream"
+        response.set_etag(etag)
+        if config.download_offload == "x-accel-redirect":
+            response.headers["X-Accel-Redirect"] = \
+                config.x_accel_prefix.rstrip("/") + "/" + filename
+        else:
+            response.headers["X-Sendfile"] = os.path.abspath(path)
+        response = response.make_conditional(request.environ)
+        if response.status_code == 304:
+            response.headers.pop("X-Accel-Redirect", None)
+            response.headers.pop("X-Sendfile", None)
+    response.headers["X-Checksum-SHA256"] = etag
+    if response.status_code in (200, 206):
+        sent = metrics.base_bytes if shared else metrics.image_bytes
+        if config.download_offload is None:
+            sent.inc(amount=response.content_length or 0)
+        else:
+            sent.inc(amount=os.path.getsize(path))
+    if shared:
+        # base images are named by their content and never change, private
+        # since they hold msmtprc and the default authorized_keys
+        response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    else:
+        # the same URL serves a different image for every token
+        response.vary.add("token")
+    return response
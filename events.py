@@ -0,0 +1,77 @@
+import json
+import queue
+import threading
+import config
+
+
+class Subscriber:
+    def __init__(self, max_size):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.dropped = False
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    def __init__(self, max_queue):
+        self.max_queue = max_queue
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        # with a relay thread running, events go through the database to
+        # the subscribers of every node, see invalidation.relay_thread_function
+        self.outbox = queue.Queue(maxsize=max_queue)
+        self.relaying = False
+        # whether this node's listener receives the relayed events
+        self.listening = False
+
+    def subscribe(self):
+        subscriber = Subscriber(self.max_queue)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, kind, **data):
+        event = (kind, data)
+        if not (self.relaying and self.listening):
+            self.deliver(event)
+        if self.relaying:
+            try:
+                self.outbox.put_nowait(event)
+            except queue.Full:
+                # the relay is behind, this node's viewers get it at least
+                if self.listening:
+                    self.deliver(event)
+
+    def deliver(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                # a viewer that cannot keep up is disconnected, its
+                # EventSource reconnects and starts from a new snapshot
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+
+    def drop_all(self):
+        # viewers reconnect and start from a new snapshot
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, set()
+        for subscriber in subscribers:
+            subscriber.dropped = True
+
+
+def format_event(kind, data):
+    return f"event: {kind}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+bus = EventBus(config.event_queue_size)
@@ -0,0 +1,106 @@
+import threading
+import db
+import images
+import machines
+
+images_all = images.ImageManager()
+machines_all = machines.MachineManager()
+# image ids whose image or allocation row changed since the last refresh
+pending = set()
+loaded = False
+# without the invalidation listener changes made by other nodes are not
+# seen, so every lookup reloads the whole fleet like before
+listening = False
+lock = threading.Lock()
+refresh_lock = threading.Lock()
+
+
+def changed(image_ids):
+    with lock:
+        pending.update(image_ids)
+
+
+def invalidate_all():
+    global loaded
+    with lock:
+        loaded = False
+
+
+def set_listening(value):
+    global listening
+    listening = value
+
+
+def add(image_manager, machine_manager, rows):
+    for image, machine in rows:
+        image_manager.add_image(image)
+        if machine is not None:
+            machine_manager.add_machine(machine)
+
+
+def load():
+    global loaded, images_all, machines_all
+    with lock:
+        pending.clear()
+        loaded = True
+    try:
+        rows = db.get_fleet()
+    except:
+        invalidate_all()
+        raise
+    new_images = images.ImageManager()
+    new_machines = machines.MachineManager()
+    add(new_images, new_machines, rows)
+    # readers keep whichever complete snapshot they already hold
+    images_all, machines_all = new_images, new_machines
+
+
+def refresh():
+    with refresh_lock:
+        if not loaded or not listening:
+            load()
+            return
+        with lock:
+            image_ids = list(pending)
+            pending.clear()
+        if not image_ids:
+            return
+        try:
+            rows = db.get_fleet(image_ids)
+        except:
+            changed(image_ids)
+            raise
+        add(images_all, machines_all, rows)
+        # an id without a row was deleted, one without a machine was released
+        images_found = {image.id for image, _ in rows}
+        machines_found = {image.id for image, machine in rows if machine is not None}
+        for image_id in image_ids:
+            if image_id not in images_found:
+                images_all.remove_image_by_id(image_id)
+            if image_id not in machines_found:
+                machines_all.remove_machine_by_image_id(image_id)
+
+
+def get_images():
+    refresh()
+    return images_all
+
+
+def get_machines():
+    refresh()
+    return machines_all
+
+
+def get_image_id_by_token(token):
+    if not listening:
+        # a full reload per request would cost more than the query it saves
+        return db.get_conf_id(token)
+    image = get_images().get_image_by_token(token)
+    return image.id if image else None
+
+
+def get_image_id_by_name(name):
+    if not listening:
+        return db.get_conf_id_name(name)
+    image = get_images().get_image_by_name(name)
+    return image.id if image else None
@@ -0,0 +1,56 @@
+import datetime
+import logging
+import threading
+import time
+from time import sleep
+import config
+import db
+import events
+
+log = logging.getLogger(__name__)
+
+
+class HeartbeatBuffer:
+    def __init__(self):
+        self.pending = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def beat(self, image_id, token):
+        with self.lock:
+            # the database turns ages into times, see boots.BootEventBuffer
+            self.pending[image_id] = time.monotonic()
+            self.tokens[image_id] = token
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            tokens, self.tokens = self.tokens, {}
+        if not pending:
+            return 0
+        now = time.monotonic()
+        try:
+            ages = {image_id: now - seen for image_id, seen in pending.items()}
+            updated = db.update_image_allocation_heartbeats(ages)
+            events.bus.publish("seen", names=list(tokens.values()),
+                               time=(datetime.datetime.utcnow() - datetime.timedelta(
+                                   seconds=min(ages.values()))).isoformat())
+            return updated
+        except:
+            with self.lock:
+                for image_id, seen in pending.items():
+                    self.pending.setdefault(image_id, seen)
+                    self.tokens.setdefault(image_id, tokens[image_id])
+            raise
+
+
+buffer = HeartbeatBuffer()
+
+
+def flush_thread_function():
+    while True:
+        sleep(config.heartbeat_flush_interval)
+        try:
+            buffer.flush()
+        except Exception as ex:
+            log.warning(f"Heartbeat flush failed: {ex}")
@@ -1,23 +1,51 @@
+import threading
+
+
 class Image:
-    def __init__(self, id, token, name, vpn_ip):
+    __slots__ = ("id", "token", "name", "vpn_ip", "password")
+
+    def __init__(self, id, token, name, vpn_ip, password=None):
         self.id = id
         self.name = name
         self.token = token
         self.vpn_ip = vpn_ip
+        self.password = password
 
 
 class ImageManager:
     def __init__(self):
-        self.images = []
+        self.by_id = {}
+        self.by_token = {}
+        self.by_name = {}
+        self.lock = threading.Lock()
 
-    def add_image(self, machine):
-        self.images.append(machine)
+    @property
+    def images(self):
+        with self.lock:
+            return [self.by_id[id] for id in sorted(self.by_id)]
 
-    def remove_image(self, machine):
-        self.images.remove(machine)
+    def add_image(self, image):
+        with self.lock:
+            self._remove(self.by_id.get(image.id))
+            self.by_id[image.id] = image
+            self.by_token[image.token] = image
+            self.by_name[image.name] = image
+
+    def remove_image_by_id(self, id):
+        with self.lock:
+            self._remove(self.by_id.get(id))
+
+    def _remove(self, image):
+        if image is None:
+            return
+        self.by_id.pop(image.id, None)
+        if self.by_token.get(image.token) is image:
+            del self.by_token[image.token]
+        if self.by_name.get(image.name) is image:
+            del self.by_name[image.name]
 
     def get_image_by_token(self, token):
-        for image in self.images:
-            if image.token == token:
-                return image
-        return None
+        return self.by_token.get(token)
+
+    def get_image_by_name(self, name):
+        return self.by_name.get(name)
@@ -0,0 +1,103 @@
+import json
+import logging
+import queue
+import select
+from time import sleep
+import db
+import downloads
+import events
+import fleet
+
+RECONNECT_DELAY = 5
+POLL_TIMEOUT = 30
+RELAY_BATCH = 100
+
+log = logging.getLogger(__name__)
+
+
+def clear_all():
+    db.token_cache.clear()
+    db.session_cache.clear()
+    downloads.clear_etags()
+    fleet.invalidate_all()
+    events.bus.drop_all()
+
+
+def handle(payload):
+    message = json.loads(payload)
+    keys = message["keys"]
+    if message["cache"] == "token":
+        for token in keys:
+            db.token_cache.invalidate(token)
+    elif message["cache"] == "session":
+        for token in keys:
+            db.session_cache.invalidate(token)
+    elif message["cache"] == "image":
+        for name in keys:
+            downloads.invalidate_image(name)
+    elif message["cache"] == "fleet":
+        fleet.changed(keys)
+
+
+def listen(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"LISTEN {db.INVALIDATE_CHANNEL}")
+        cur.execute(f"LISTEN {db.EVENT_CHANNEL}")
+    # anything cached before LISTEN may have missed its notification
+    clear_all()
+    fleet.set_listening(True)
+    events.bus.listening = True
+    while True:
+        if select.select([conn], [], [], POLL_TIMEOUT) == ([], [], []):
+            # wakes up a connection the server silently dropped
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+        conn.poll()
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            try:
+                if notify.channel == db.EVENT_CHANNEL:
+                    message = json.loads(notify.payload)
+                    events.bus.deliver((message["kind"], message["data"]))
+                else:
+                    handle(notify.payload)
+            except Exception as ex:
+                log.warning(f"Bad invalidation message {notify.payload!r}: {ex}")
+
+
+def listen_thread_function():
+    while True:
+        conn = None
+        try:
+            conn = db.dedicated_connection()
+            listen(conn)
+        except Exception as ex:
+            log.warning(f"Cache invalidation listener failed: {ex}")
+        finally:
+            if conn is not None:
+                conn.close()
+        # until the listener is back, entries only expire by their TTL
+        # and the fleet is reloaded on every lookup
+        fleet.set_listening(False)
+        events.bus.listening = False
+        clear_all()
+        sleep(RECONNECT_DELAY)
+
+
+def relay_thread_function():
+    # every node publishing events runs this, including a separate services.py
+    events.bus.relaying = True
+    while True:
+        batch = [events.bus.outbox.get()]
+        try:
+            while len(batch) < RELAY_BATCH:
+                batch.append(events.bus.outbox.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            db.relay_events(batch)
+        except Exception as ex:
+            log.warning(f"Relaying {len(batch)} events failed: {ex}")
+            if events.bus.listening:
+                for event in batch:
+                    events.bus.deliver(event)
@@ -0,0 +1,77 @@
+import os
+import socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import config
+import db
+
+LOG_TAIL_LINES = 50
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue:
+    def __init__(self, workers, log_folder):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="job")
+        self.log_folder = log_folder
+
+    def submit(self, kind, params, function, *args, reserve=None):
+        # reserve is (image names, tokens) the job will create, returns None
+        # when an image or another unfinished job already has one of them
+        job_id = db.add_job(kind, params, worker_name(), reserve)
+        if job_id is None:
+            return None
+        self.executor.submit(self.run, job_id, function, args)
+        return job_id
+
+    def log_path(self, job_id):
+        return os.path.join(self.log_folder, f"{job_id}.log")
+
+    def run(self, job_id, function, args):
+        db.start_job(job_id)
+        os.makedirs(self.log_folder, exist_ok=True)
+        result = None
+        with open(self.log_path(job_id), "w") as log:
+            try:
+                result = function(*args, log=log)
+                status = "done"
+            except Exception as ex:
+                log.write(f"\n{type(ex).__name__}: {ex}\n")
+                status = "failed"
+        db.finish_job(job_id, status, result, self.log_tail(job_id))
+
+    def log_tail(self, job_id, lines=LOG_TAIL_LINES):
+        try:
+            with open(self.log_path(job_id), errors="replace") as log:
+                return "".join(deque(log, lines))
+        except OSError:
+            return ""
+
+    def get(self, job_id):
+        job = db.get_job(job_id)
+        if job is not None and job["status"] in ("queued", "running"):
+            job["log"] = self.log_tail(job_id)
+        return job
+
+
+def fail_interrupted_jobs():
+    # jobs run in the process that queued them, so an unfinished job whose
+    # process is gone on this host will never finish
+    host = socket.gethostname()
+    for job_id, worker in db.get_unfinished_jobs():
+        worker_host, _, pid = worker.rpartition(":")
+        if worker_host != host:
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            db.finish_job(job_id, "failed", None,
+                          "Interrupted by server restart\n")
+        except (ValueError, PermissionError):
+            pass
+
+
+queue = JobQueue(config.job_workers, config.job_log_folder)
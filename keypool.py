@@ -0,0 +1,90 @@
+import logging
+import os
+import subprocess
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import config
+import utils
+
+log = logging.getLogger(__name__)
+
+
+class KeyPool:
+    def __init__(self, folder, lengths, size, workers):
+        self.folder = folder
+        self.lengths = lengths
+        self.size = size
+        # every key is generated by its own uVPN_rsagen process, so the
+        # worker threads spread key generation over the available cores
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="keypool")
+        self.pending = {length: 0 for length in lengths}
+        self.lock = threading.Lock()
+
+    def path(self, length):
+        return os.path.join(self.folder, str(length))
+
+    def keys(self, length):
+        try:
+            return sorted(name for name in os.listdir(self.path(length))
+                          if name.endswith(".priv"))
+        except FileNotFoundError:
+            return []
+
+    def take(self, length):
+        if length not in self.lengths:
+            return None
+        try:
+            for name in self.keys(length):
+                claimed = os.path.join(self.path(length), name + ".taken")
+                try:
+                    os.rename(os.path.join(self.path(length), name), claimed)
+                except FileNotFoundError:
+                    # claimed by another worker in the meantime
+                    continue
+                return claimed
+            return None
+        finally:
+            self.refill(length)
+
+    def refill(self, length=None):
+        rsagen = os.path.join(utils.toolchain_path(), "uVPN_rsagen")
+        if not os.path.exists(rsagen):
+            return
+        lengths = self.lengths if length is None else [length]
+        with self.lock:
+            for length in lengths:
+                missing = self.size - len(self.keys(length)) - self.pending[length]
+                for _ in range(missing):
+                    self.pending[length] += 1
+                    self.executor.submit(self.generate, rsagen, length)
+
+    def generate(self, rsagen, length):
+        directory = self.path(length)
+        name = uuid.uuid4().hex
+        tmp_path = os.path.join(directory, name + ".tmp")
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "w") as key_file:
+                subprocess.run([rsagen, str(length)], stdout=key_file,
+                               stderr=subprocess.DEVNULL, check=True)
+            os.rename(tmp_path, os.path.join(directory, name + ".priv"))
+        except Exception as ex:
+            log.warning(f"Generating a {length} bit key failed: {ex}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            with self.lock:
+                self.pending[length] -= 1
+
+    def stats(self):
+        with self.lock:
+            return {length: {"ready": len(self.keys(length)),
+                             "pending": self.pending[length]}
+                    for length in self.lengths}
+
+
+pool = KeyPool(config.keypool_folder, config.keypool_lengths,
+               config.keypool_size, config.keypool_workers)
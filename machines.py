@@ -1,5 +1,14 @@
+import threading
+
+
 class Machine:
-    def __init__(self, name, image_name, start_time, ipvpn, iplocal, username, password):
+    __slots__ = ("id", "image_id", "name", "image_name", "start_time", "ipvpn",
+                 "iplocal", "username", "password")
+
+    def __init__(self, name, image_name, start_time, ipvpn, iplocal, username, password,
+                 id=None, image_id=None):
+        self.id = id
+        self.image_id = image_id
         self.name = name
         self.image_name = image_name
         self.start_time = start_time
@@ -8,19 +17,65 @@ class Machine:
         self.username = username
         self.password = password
 
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "image_name": self.image_name,
+            "start_time": self.start_time.isoformat() if self.start_time else None,
+            "ipvpn": self.ipvpn,
+            "iplocal": self.iplocal,
+            "username": self.username,
+        }
+
 
 class MachineManager:
     def __init__(self):
-        self.machines = []
+        # one allocation per image, so image_id identifies a machine as well
+        self.by_image_id = {}
+        self.by_image_name = {}
+        self.by_ipvpn = {}
+        self.lock = threading.Lock()
+
+    @property
+    def machines(self):
+        return self.page()[0]
+
+    def page(self, limit=None, offset=0, image_name=None, order="asc"):
+        # returns (machines, total) ordered by start time like the
+        # image_allocation_allocation_time_idx listing it replaces
+        with self.lock:
+            if image_name is not None:
+                machine = self.by_image_name.get(image_name)
+                selected = [machine] if machine is not None else []
+            else:
+                selected = list(self.by_image_id.values())
+        selected.sort(key=lambda machine: (machine.start_time, machine.id),
+                      reverse=order == "desc")
+        if limit is None:
+            return selected[offset:], len(selected)
+        return selected[offset:offset + limit], len(selected)
 
     def add_machine(self, machine):
-        self.machines.append(machine)
+        with self.lock:
+            self._remove(self.by_image_id.get(machine.image_id))
+            self.by_image_id[machine.image_id] = machine
+            self.by_image_name[machine.image_name] = machine
+            if machine.ipvpn is not None:
+                self.by_ipvpn[machine.ipvpn] = machine
+
+    def remove_machine_by_image_id(self, image_id):
+        with self.lock:
+            self._remove(self.by_image_id.get(image_id))
 
-    def remove_machine(self, machine):
-        self.machines.remove(machine)
+    def _remove(self, machine):
+        if machine is None:
+            return
+        self.by_image_id.pop(machine.image_id, None)
+        if self.by_image_name.get(machine.image_name) is machine:
+            del self.by_image_name[machine.image_name]
+        if self.by_ipvpn.get(machine.ipvpn) is machine:
+            del self.by_ipvpn[machine.ipvpn]
 
-    def get_machine_by_name(self, name):
-        for machine in self.machines:
-            if machine.name == name:
-                return machine
-        return None
+    def get_machine_by_ipvpn(self, ipvpn):
+        return self.by_ipvpn.get(ipvpn)
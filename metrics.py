@@ -0,0 +1,163 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+                for key, value in items]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Callback(Metric):
+    # values are read at scrape time, function returns {label values: value}
+    def __init__(self, name, help, labels, type, function):
+        super().__init__(name, help, labels)
+        self.type = type
+        self.function = function
+
+    def samples(self):
+        try:
+            values = self.function()
+        except Exception:
+            return []
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+                for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(key, (list(counts), total, count))
+                     for key, (counts, total, count) in self.values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket"
+                             f"{format_labels(self.labels, key, [('le', format_value(float(bound)))])}"
+                             f" {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+registry = []
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.header()
+        lines += metric.samples()
+    return "\n".join(lines) + "\n"
+
+
+http_requests = Counter(
+    "http_requests_total", "HTTP requests by route, method and status",
+    ("route", "method", "status"))
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route",
+    ("route", "method"))
+db_query_seconds = Histogram(
+    "db_query_duration_seconds", "Database calls and their latency by db.py function",
+    ("function",))
+db_pool_waiting = Gauge(
+    "db_pool_waiting", "Threads waiting for a pooled database connection")
+allocation_sweep_seconds = Histogram(
+    "allocation_sweep_duration_seconds", "Duration of allocation monitor sweeps")
+allocation_sweep_alive = Gauge(
+    "allocation_sweep_alive", "Allocations found alive in the last sweep")
+allocation_expired = Counter(
+    "allocation_expired_total", "Allocations deleted by the monitor")
+allocations = Gauge(
+    "allocations", "Current number of image allocations")
+image_bytes = Counter(
+    "getconf_bytes_total", "Bytes of config images served by /api/getconf")
+base_bytes = Counter(
+    "getbase_bytes_total", "Bytes of shared base images served by /api/getbase")
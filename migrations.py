@@ -0,0 +1,131 @@
+import logging
+
+# Every schema change is appended here as a new version. Applied versions
+# are recorded in schema_version and never run again.
+MIGRATIONS = [
+    (1, "initial schema", [
+        """
+        CREATE TABLE IF NOT EXISTS image (
+            id SERIAL PRIMARY KEY,
+            image_name VARCHAR(255) NOT NULL,
+            token VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            password VARCHAR(128) NOT NULL,
+            vpn_ip INET
+        );""",
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            password VARCHAR(256) NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );""",
+        """
+        CREATE TABLE IF NOT EXISTS auth_tokens (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            token VARCHAR(64) NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            expires_on TIMESTAMP NOT NULL
+        );""",
+        """
+        CREATE TABLE IF NOT EXISTS image_allocation (
+            id SERIAL PRIMARY KEY,
+            image_id INTEGER NOT NULL REFERENCES image(id),
+            allocation_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_access_time TIMESTAMP,
+            client_ip_local INET,
+            client_ip_vpn INET
+        );""",
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id SERIAL PRIMARY KEY,
+            kind VARCHAR(32) NOT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'queued',
+            params JSONB,
+            result JSONB,
+            log TEXT,
+            worker VARCHAR(255),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        );""",
+    ]),
+    (2, "indexes, one allocation per image, cascade deletes", [
+        # the old check-then-insert could leave several allocations of one image
+        """
+        DELETE FROM image_allocation a USING image_allocation b
+        WHERE a.image_id = b.image_id AND a.id < b.id""",
+        "CREATE UNIQUE INDEX image_token_key ON image (token)",
+        "CREATE UNIQUE INDEX image_image_name_key ON image (image_name)",
+        """
+        ALTER TABLE image_allocation
+        ADD CONSTRAINT image_allocation_image_id_key UNIQUE (image_id)""",
+        """
+        ALTER TABLE image_allocation
+        DROP CONSTRAINT IF EXISTS image_allocation_image_id_fkey,
+        ADD CONSTRAINT image_allocation_image_id_fkey FOREIGN KEY (image_id)
+            REFERENCES image(id) ON DELETE CASCADE""",
+        """
+        CREATE INDEX image_allocation_allocation_time_idx
+        ON image_allocation (allocation_time)""",
+        "CREATE UNIQUE INDEX auth_tokens_token_key ON auth_tokens (token)",
+        "CREATE INDEX auth_tokens_expires_on_idx ON auth_tokens (expires_on)",
+    ]),
+    (3, "content-addressed image blobs", [
+        # refcount is the number of image rows pointing at the blob
+        """
+        CREATE TABLE blob (
+            digest CHAR(64) PRIMARY KEY,
+            size BIGINT NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+        """
+        ALTER TABLE image
+        ADD COLUMN image_digest CHAR(64),
+        ADD COLUMN pub_digest CHAR(64)""",
+    ]),
+    (4, "boot timeline", [
+        # one row per allocation, started_at equals its allocation_time and
+        # events maps each phase to seconds since then
+        """
+        CREATE TABLE boot (
+            id SERIAL PRIMARY KEY,
+            image_id INTEGER NOT NULL REFERENCES image(id) ON DELETE CASCADE,
+            started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            events JSONB NOT NULL DEFAULT '{}'
+        )""",
+        "CREATE INDEX boot_image_id_started_at_idx ON boot (image_id, started_at)",
+        "CREATE INDEX boot_started_at_idx ON boot (started_at)",
+    ]),
+]
+
+MIGRATION_LOCK = 7164001
+
+log = logging.getLogger(__name__)
+
+
+def migrate(conn):
+    with conn.cursor() as cur:
+        # several workers may start at once, only one of them migrates
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK,))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );""")
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        current = cur.fetchone()[0]
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute("""
+                INSERT INTO schema_version (version, description)
+                VALUES (%s, %s)
+            """, (version, description,))
+            log.info(f"Applied migration {version}: {description}")
+    conn.commit()
@@ -0,0 +1,49 @@
+import socket
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def icmp_probe(ip, timeout):
+    try:
+        result = subprocess.run(
+            ["ping", "-c", "1", "-W", str(max(1, round(timeout))), ip],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            timeout=timeout + 1)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
+
+
+def tcp_probe(ip, timeout, port):
+    try:
+        with socket.create_connection((ip, port), timeout=timeout):
+            return True
+    except ConnectionRefusedError:
+        # a RST still means the host answered
+        return True
+    except OSError:
+        return False
+
+
+class ProbeEngine:
+    def __init__(self, mode, concurrency, timeout, port):
+        if mode not in ("icmp", "tcp"):
+            raise ValueError(f"Unknown probe mode: {mode}")
+        self.mode = mode
+        self.timeout = timeout
+        self.port = port
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="probe")
+        self.sweep_lock = threading.Lock()
+
+    def probe(self, ip):
+        if self.mode == "tcp":
+            return tcp_probe(ip, self.timeout, self.port)
+        return icmp_probe(ip, self.timeout)
+
+    def probe_all(self, ips):
+        unique_ips = list(set(ips))
+        with self.sweep_lock:
+            results = self.executor.map(self.probe, unique_ips)
+            return dict(zip(unique_ips, results))
@@ -0,0 +1,161 @@
+import argparse
+import fcntl
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import config
+
+# mksquashfs options per profile, every profile uses all cores
+PROFILES = {
+    "test": ["-comp", "zstd", "-Xcompression-level", "3", "-b", "1048576"],
+    "release": ["-comp", "xz", "-Xdict-size", "100%", "-b", "1048576"],
+}
+APT_CACHE = "var/cache/apt/archives"
+# apt's own lock in the shared archives fails at once instead of waiting
+APT_CACHE_LOCK = ".rootfs.lock"
+PACKAGE_NAME = re.compile(r"[a-z0-9][a-z0-9+.:=~_-]*")
+
+
+def command(args):
+    # the server is not necessarily run as root
+    if os.geteuid() != 0:
+        return ["sudo", "-n"] + args
+    return args
+
+
+class Build:
+    def __init__(self, log):
+        self.log = log
+        self.stages = []
+
+    def run(self, args):
+        self.log.flush()
+        subprocess.run(command(args), stdout=self.log,
+                       stderr=subprocess.STDOUT, check=True)
+
+    def chroot(self, root, script):
+        self.run(["chroot", root, "/bin/bash", "-c", script])
+
+    def stage(self, name, function, *args):
+        self.log.write(f"==> {name}\n")
+        started = time.monotonic()
+        try:
+            function(*args)
+        finally:
+            seconds = round(time.monotonic() - started, 1)
+            self.stages.append({"stage": name, "seconds": seconds})
+            self.log.write(f"==> {name}: {seconds}s\n")
+            self.log.flush()
+
+
+def mount_points(root):
+    return [("/dev/pts", os.path.join(root, "dev/pts")),
+            ("/proc", os.path.join(root, "proc")),
+            (os.path.abspath(config.apt_cache_dir), os.path.join(root, APT_CACHE))]
+
+
+def mount(build, root):
+    for source, target in mount_points(root):
+        os.makedirs(target, exist_ok=True)
+        build.run(["mount", "--bind", source, target])
+
+
+def unmount(build, root):
+    for _, target in reversed(mount_points(root)):
+        if os.path.ismount(target):
+            build.run(["umount", target])
+
+
+def apt(build, root, packages, upgrade):
+    build.chroot(root, "echo 'nameserver 1.1.1.1' > /etc/resolv.conf")
+    build.stage("apt update", build.chroot, root, "apt-get update")
+    if not upgrade and not packages:
+        return
+    # builds share the archives, so only one of them downloads and
+    # installs packages at a time; unsquashfs and mksquashfs still overlap
+    with open(os.path.join(config.apt_cache_dir, APT_CACHE_LOCK), "w") as lock:
+        build.stage("apt lock", fcntl.flock, lock, fcntl.LOCK_EX)
+        if upgrade:
+            build.stage("apt upgrade", build.chroot, root,
+                        "DEBIAN_FRONTEND=noninteractive apt-get upgrade -y")
+        if packages:
+            build.stage("apt install", build.chroot, root,
+                        "DEBIAN_FRONTEND=noninteractive apt-get install -y "
+                        + " ".join(packages))
+
+
+def build_rootfs(source, name, packages=(), upgrade=False, profile="release",
+                 output_folder=None, log=sys.stdout):
+    for package in packages:
+        if PACKAGE_NAME.fullmatch(package) is None:
+            raise ValueError(f"Invalid package name: {package}")
+    output_folder = output_folder or config.rootfs_folder
+    output = os.path.join(output_folder, name + ".squashfs")
+    partial = os.path.join(output_folder, f".{name}.{os.getpid()}.partial")
+    processors = str(os.cpu_count() or 1)
+    os.makedirs(config.rootfs_scratch, exist_ok=True)
+    os.makedirs(os.path.join(config.apt_cache_dir, "partial"), exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix="rootfs-", dir=config.rootfs_scratch)
+    root = os.path.join(scratch, "root")
+    build = Build(log)
+    mounted = False
+    try:
+        build.stage("unsquashfs", build.run,
+                    ["unsquashfs", "-processors", processors, "-d", root, source])
+        mounted = True
+        build.stage("mount", mount, build, root)
+        apt(build, root, list(packages), upgrade)
+        # unmounting the shared cache first keeps its packages for the next build
+        build.stage("unmount", unmount, build, root)
+        mounted = False
+        build.chroot(root, "apt-get clean")
+        build.stage("mksquashfs", build.run,
+                    ["mksquashfs", root, partial, "-noappend",
+                     "-processors", processors] + PROFILES[profile])
+        build.run(["mv", partial, output])
+    finally:
+        try:
+            if mounted:
+                unmount(build, root)
+            build.run(["rm", "-rf", scratch, partial])
+        except subprocess.CalledProcessError:
+            # removing the scratch dir would delete through the bind mounts
+            log.write(f"Bind mounts under {root} are still mounted, "
+                      "leaving the scratch directory in place\n")
+    total = round(sum(stage["seconds"] for stage in build.stages), 1)
+    log.write(f"==> total: {total}s\n")
+    return {"rootfs": os.path.basename(output), "profile": profile,
+            "size": os.path.getsize(output), "stages": build.stages,
+            "seconds": total}
+
+
+def sources():
+    try:
+        return sorted(name for name in os.listdir(config.rootfs_folder)
+                      if name.endswith(".squashfs"))
+    except FileNotFoundError:
+        return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a rootfs squashfs image")
+    parser.add_argument("-s", "--source", required=True, help="source squashfs image")
+    parser.add_argument("-n", "--name", required=True, help="output image name")
+    parser.add_argument("-i", "--install", action="append", default=[],
+                        help="packages to install")
+    parser.add_argument("-u", "--upgrade", action="store_true")
+    parser.add_argument("-p", "--profile", choices=PROFILES, default="release")
+    parser.add_argument("-o", "--output-folder", default=".")
+    args = parser.parse_args()
+    packages = [package for packages in args.install for package in packages.split()]
+    result = build_rootfs(args.source, args.name, packages, args.upgrade,
+                          args.profile, args.output_folder)
+    for stage in result["stages"]:
+        print(f"{stage['stage']:>12}: {stage['seconds']}s")
+
+
+if __name__ == '__main__':
+    main()
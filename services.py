@@ -0,0 +1,126 @@
+import atexit
+import logging
+import signal
+import subprocess
+import threading
+import psycopg2
+import config
+import db
+import utils
+import invalidation
+import jobs
+import keypool
+
+# pg_advisory_lock key held by the instance that runs the background services
+LEADER_LOCK = 7164002
+WSSH_RESTART_DELAY = 5
+
+log = logging.getLogger(__name__)
+stopping = threading.Event()
+elector = None
+
+
+def try_lock(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (LEADER_LOCK,))
+        return cur.fetchone()[0]
+
+
+def still_leader(conn):
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def webssh_thread_function(stop):
+    while not stop.is_set():
+        process = subprocess.Popen(
+            ['wssh', '--fbidhttp=False', '--port='+config.webssh_port])
+        while process.poll() is None:
+            if stop.wait(1):
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                return
+        log.warning(f"wssh exited with {process.returncode}, restarting")
+        stop.wait(WSSH_RESTART_DELAY)
+
+
+def lead(conn):
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=webssh_thread_function, args=(stop,), daemon=True),
+        threading.Thread(target=utils.check_allocation_thread_function,
+                         args=(stop,), daemon=True),
+        threading.Thread(target=utils.purge_sessions_thread_function,
+                         args=(stop,), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    keypool.pool.refill()
+    try:
+        while not stopping.is_set() and still_leader(conn):
+            stopping.wait(config.leader_poll_interval)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def elect():
+    conn = None
+    while not stopping.is_set():
+        try:
+            if conn is None or conn.closed:
+                # the session lock lives as long as this connection
+                conn = db.dedicated_connection()
+            if try_lock(conn):
+                log.info(f"Running background services as {jobs.worker_name()}")
+                lead(conn)
+                if not stopping.is_set():
+                    log.warning("Lost the leader lock, background services stopped")
+                # dropping the connection also drops the lock if it is still held
+                conn.close()
+        except Exception as ex:
+            log.warning(f"Leader election failed: {ex}")
+            if conn is not None:
+                conn.close()
+        stopping.wait(config.leader_poll_interval)
+
+
+def stop():
+    # let the leader terminate wssh before the interpreter kills daemon threads
+    stopping.set()
+    if elector is not None:
+        elector.join(config.leader_poll_interval + 15)
+
+
+def start():
+    global elector
+    if elector is not None:
+        return
+    elector = threading.Thread(target=elect, daemon=True)
+    elector.start()
+    atexit.register(stop)
+
+
+def main():
+    logging.basicConfig(level=config.log_level)
+    db.connect()
+    # the monitor's events reach dashboards on the HTTP workers
+    threading.Thread(target=invalidation.relay_thread_function, daemon=True).start()
+    # systemd stops the service with SIGTERM, unwind so wssh is terminated too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        elect()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
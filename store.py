@@ -0,0 +1,92 @@
+import argparse
+import hashlib
+import os
+import db
+
+BLOB_FOLDER = "blobs"
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_path(upload_folder, digest):
+    return os.path.join(upload_folder, BLOB_FOLDER, digest[:2], digest)
+
+
+def put(path, upload_folder):
+    # the named file stays where it is and becomes a hardlink to its blob,
+    # identical content is kept on disk once
+    digest = hash_file(path)
+    blob = blob_path(upload_folder, digest)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+        os.link(path, blob)
+    except FileExistsError:
+        if not os.path.samefile(path, blob):
+            temporary = path + ".link"
+            os.link(blob, temporary)
+            os.replace(temporary, path)
+    return digest, os.path.getsize(blob)
+
+
+def remove(digests, upload_folder):
+    for digest in digests:
+        try:
+            os.remove(blob_path(upload_folder, digest))
+        except FileNotFoundError:
+            pass
+
+
+def remove_unreferenced(digests, upload_folder):
+    # blobs put for images whose insert failed, unless another image has them
+    referenced = set(db.get_blob_digests())
+    remove([digest for digest in digests if digest not in referenced], upload_folder)
+
+
+def backfill(upload_folder):
+    for image_id, image_name in db.get_images_without_blobs():
+        image = os.path.join(upload_folder, image_name)
+        pub = os.path.join(upload_folder, image_name.split(".")[0] + ".pub")
+        if not os.path.exists(image):
+            print(f"{image_name}: missing, skipped")
+            continue
+        image_blob = put(image, upload_folder)
+        pub_blob = put(pub, upload_folder) if os.path.exists(pub) else None
+        db.set_image_blobs(image_id, image_blob, pub_blob)
+        print(f"{image_name}: {image_blob[0]}")
+
+
+def gc(upload_folder):
+    # blob files left behind by builds whose images never reached the database
+    referenced = set(db.get_blob_digests())
+    root = os.path.join(upload_folder, BLOB_FOLDER)
+    if not os.path.isdir(root):
+        return
+    for prefix in os.listdir(root):
+        for digest in os.listdir(os.path.join(root, prefix)):
+            if digest not in referenced:
+                os.remove(os.path.join(root, prefix, digest))
+                print(f"removed {digest}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the image blob store")
+    parser.add_argument("--upload-folder", default="squash")
+    parser.add_argument("--backfill", action="store_true",
+                        help="hash images created before the blob store")
+    parser.add_argument("--gc", action="store_true",
+                        help="remove blobs no image refers to")
+    args = parser.parse_args()
+    if args.backfill:
+        backfill(args.upload_folder)
+    if args.gc:
+        gc(args.upload_folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import logging
+import psycopg2
+import pytest
+import config
+import tracing
+
+
+@pytest.fixture
+def slow_log(tmp_path, monkeypatch):
+    path = tmp_path / "slow_queries.log"
+    monkeypatch.setattr(config, "slow_query_ms", 0)
+    monkeypatch.setattr(config, "slow_query_log", str(path))
+    monkeypatch.setattr(tracing, "slow_log", None)
+    yield path
+    logger = logging.getLogger("slow_query")
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+
+
+@pytest.fixture
+def cur():
+    try:
+        conn = psycopg2.connect(database=config.database, host=config.host,
+                                user=config.user, password=config.password,
+                                port=config.port, connect_timeout=3,
+                                cursor_factory=tracing.TracingCursor)
+    except psycopg2.OperationalError as ex:
+        pytest.skip(f"PostgreSQL is not available: {ex}")
+    with conn.cursor() as cur:
+        cur.execute("CREATE TEMP TABLE secrets (token TEXT, password TEXT)")
+        yield cur
+    conn.close()
+
+
+def test_execute_values_logs_template_without_values(slow_log, cur):
+    tracing.start("/test")
+    tracing.execute_values(cur, "INSERT INTO secrets (token, password) VALUES %s",
+                           [("token-a1b2c3", "$6$hash-d4e5f6"),
+                            ("token-g7h8i9", "$6$hash-j0k1l2")])
+    trace = tracing.stop()
+    cur.execute("SELECT count(*) FROM secrets WHERE token = %s", ("token-a1b2c3",))
+    assert cur.fetchone()[0] == 1
+
+    logged = slow_log.read_text()
+    assert "INSERT INTO secrets (token, password) VALUES %s -- 2 rows of values" in logged
+    traced = " ".join(sql for sql, _, _ in trace.statements)
+    for text in (logged, traced):
+        for value in ("token-a1b2c3", "hash-d4e5f6", "token-g7h8i9", "hash-j0k1l2"):
+            assert value not in text
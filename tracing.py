@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+from psycopg2 import extras
+from psycopg2.extensions import cursor
+import config
+
+log = logging.getLogger(__name__)
+local = threading.local()
+slow_log = None
+slow_log_lock = threading.Lock()
+
+
+class Trace:
+    def __init__(self, route):
+        self.route = route
+        self.statements = []
+
+    def total(self):
+        return sum(duration for _, duration, _ in self.statements)
+
+
+def start(route):
+    local.trace = Trace(route)
+
+
+def stop():
+    trace = getattr(local, "trace", None)
+    local.trace = None
+    return trace
+
+
+def get_slow_log():
+    global slow_log
+    with slow_log_lock:
+        if slow_log is None:
+            slow_log = logging.getLogger("slow_query")
+            slow_log.propagate = False
+            handler = logging.FileHandler(config.slow_query_log)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            slow_log.addHandler(handler)
+            slow_log.setLevel(logging.INFO)
+    return slow_log
+
+
+def statement_text(sql):
+    if isinstance(sql, bytes):
+        sql = sql.decode(errors="replace")
+    elif not isinstance(sql, str):
+        sql = str(sql)
+    sql = " ".join(sql.split())
+    return sql if len(sql) <= 500 else sql[:500] + "..."
+
+
+def record(sql, duration, rows):
+    trace = getattr(local, "trace", None)
+    if trace is not None:
+        trace.statements.append((sql, duration, rows))
+    if duration * 1000 >= config.slow_query_ms:
+        route = trace.route if trace is not None else threading.current_thread().name
+        get_slow_log().info(f"{duration * 1000:.1f}ms route={route} rows={rows} "
+                            f"{statement_text(sql)}")
+
+
+class TracingCursor(cursor):
+    # set by execute_values, recorded instead of the statement it executes
+    template = None
+
+    def execute(self, sql, args=None):
+        started = time.perf_counter()
+        rows = -1
+        try:
+            result = super().execute(sql, args)
+            rows = self.rowcount
+            return result
+        finally:
+            record(self.template or sql, time.perf_counter() - started, rows)
+
+    def executemany(self, sql, args_list):
+        started = time.perf_counter()
+        rows = -1
+        try:
+            result = super().executemany(sql, args_list)
+            rows = self.rowcount
+            return result
+        finally:
+            record(sql, time.perf_counter() - started, rows)
+
+
+def execute_values(cur, sql, argslist, **kwargs):
+    # psycopg2's execute_values inlines every value into the statement it
+    # executes, tokens and password hashes must not reach the logs
+    if not isinstance(cur, TracingCursor):
+        return extras.execute_values(cur, sql, argslist, **kwargs)
+    cur.template = f"{sql} -- {len(argslist)} rows of values"
+    try:
+        return extras.execute_values(cur, sql, argslist, **kwargs)
+    finally:
+        cur.template = None
+
+
+def log_trace(trace, method, status):
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    lines = [f"{method} {trace.route} {status}: {len(trace.statements)} queries "
+             f"in {trace.total() * 1000:.1f}ms"]
+    for sql, duration, rows in trace.statements:
+        lines.append(f"  {duration * 1000:.1f}ms rows={rows} {statement_text(sql)}")
+    log.debug("\n".join(lines))
@@ -1,41 +1,25 @@
 #!/bin/bash
 
 echo "Parametry podane do skryptu: $@"
-usage() { echo "Usage: [ -n <nazwa obrazu>] [ -s <obraz zródłowy>] [-u <yes - upgrade>] [-i <pakiety do instalacji>]" 1>&2; exit 1; }
+usage() { echo "Usage: [ -n <nazwa obrazu>] [ -s <obraz zródłowy>] [-u <yes - upgrade>] [-i <pakiety do instalacji>] [-p <test|release>]" 1>&2; exit 1; }
 
-while getopts "n:u:i:s:" option
+profile="release"
+while getopts "n:u:i:s:p:" option
 do
     case "${option}"
         in
           n)name=${OPTARG};;
-          u)upgrade="yes";;
-          i)packages+=("$OPTARG");;
+          u)upgrade="--upgrade";;
+          i)packages+=("-i" "$OPTARG");;
           s)squashfs=${OPTARG};;
+          p)profile=${OPTARG};;
           *)usage;;
     esac
 done
 shift $((OPTIND -1))
 
-echo "Pakiety: ${packages[@]}"
-echo "$squashfs"
-sudo unsquashfs -d /tmp/squashfs $squashfs
-sudo mount --bind /dev/pts /tmp/squashfs/dev/pts
-sudo mount --bind /proc /tmp/squashfs/proc
-sudo chroot /tmp/squashfs/ /bin/bash -c 'cat <<EOF> /etc/resolv.conf
-nameserver 1.1.1.1
-EOF'
-sudo chroot /tmp/squashfs/ /bin/bash -c 'apt update'
-
-if [ -n "$upgrade" ]; then
-  sudo chroot /tmp/squashfs/ /bin/bash -c 'DEBIAN_FRONTEND=noninteractive apt upgrade -y'
-fi
-if [ -n "$packages" ]; then
-  sudo chroot /tmp/squashfs/ /bin/bash -c "DEBIAN_FRONTEND=noninteractive apt install ${packages[@]} -y"
-fi
-
-sudo chroot /tmp/squashfs/ /bin/bash -c 'apt clean all'
-sudo umount /tmp/squashfs/dev/pts
-sudo umount /tmp/squashfs/proc
-sudo rm -rf $name.squashfs
-sudo mksquashfs /tmp/squashfs/ $name.squashfs -noappend -b 1048576 -comp xz -Xdict-size 100%
-sudo rm -rf /tmp/squashfs
\ No newline at end of file
+# the build itself lives in rootfs.py, which is also used by the admin panel
+squashfs=$(realpath "$squashfs")
+output=$(pwd)
+cd "$(dirname "$0")"
+exec python3 rootfs.py -s "$squashfs" -n "$name" -p "$profile" -o "$output" $upgrade "${packages[@]}"
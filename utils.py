@@ -1,21 +1,31 @@
 import datetime
 import hashlib
+import logging
 import secrets
 import string
 import random
 import os
-import subprocess
 import threading
-from time import sleep
+import time
 import db
+import fleet
 import config
+import probe
+import heartbeat
+import events
+import invalidation
+import boots
+import metrics
 import ipaddress
+import re
 from os import chmod
 from Crypto.PublicKey import RSA
 
 DELETE_TIMEOUT = 45
 RESTART_DELETE_THREAD = 3
 
+log = logging.getLogger(__name__)
+
 
 def generate_random_string(length):
     letters = string.ascii_letters
@@ -32,59 +42,114 @@ def generate_auth_token():
 
 
 def ping_client(ip):
-    response = os.system("ping -c 1 " + ip + "> /dev/null")
-
-    if response == 0:
-        return True
-    else:
-        return False
-
-
-def ssh_thread_function():
-    subprocess.run(['wssh', '--fbidhttp=False', '--port='+config.webssh_port])
+    return probe.icmp_probe(ip, config.probe_timeout)
 
 
+def toolchain_path():
+    # the uVPN and kit-crypto versions are defined in create.sh
+    with open(os.path.join(os.getcwd(), 'configs', 'create.sh')) as script:
+        versions = dict(re.findall(r'^(\w+_version)="([^"]+)"', script.read(), re.M))
+    return os.path.join(os.path.abspath(config.toolchain_dir),
+                        f"uVPN-{versions['uvpn3_version']}-kit-crypto-{versions['kitcrypto_version']}")
 
-def check_allocation_thread_function():
-    while True:
-        ids = db.get_image_allocation_all()
-        if ids is not None:
-            for x in ids:
-                ip = db.get_image_allocation_clientip_id_vpn(x[0])
-                ping_thread = PingThread(ip, x[0])
-                ping_thread.start()
-
-        sleep(RESTART_DELETE_THREAD)
 
+def check_allocation_thread_function(stop):
+    engine = probe.ProbeEngine(config.probe_mode, config.probe_concurrency,
+                               config.probe_timeout, config.probe_port)
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                sweep_allocations(engine)
+            except Exception as ex:
+                log.exception(f"Allocation sweep failed: {ex}")
+
+            stop.wait(max(0, RESTART_DELETE_THREAD - (time.monotonic() - started)))
+    finally:
+        # a new engine is built for every leadership term
+        engine.executor.shutdown()
+
+
+def sweep_allocations(engine):
+    started = time.monotonic()
+    if config.liveness_mode == "heartbeat":
+        heartbeat.buffer.flush()
+    fleet_machines = fleet.get_machines()
+    machines_list = fleet_machines.machines
+    if config.liveness_mode == "heartbeat":
+        ips = []
+        alive_ids = []
+    else:
+        ips = [machine.ipvpn for machine in machines_list if machine.ipvpn is not None]
+        alive = engine.probe_all(ips)
+        alive_ids = []
+        for ip in ips:
+            machine = fleet_machines.get_machine_by_ipvpn(ip)
+            if alive.get(ip) and machine is not None:
+                alive_ids.append(machine.id)
+
+    now = datetime.datetime.utcnow()
+    tokens = {machine.id: machine.name for machine in machines_list}
+    # the database only deletes the ones not seen within DELETE_TIMEOUT
+    alive_set = set(alive_ids)
+    expired_ids = [machine.id for machine in machines_list
+                   if machine.id not in alive_set
+                   and (machine.ipvpn is not None or config.liveness_mode == "heartbeat")]
+
+    updated, deleted_ids = db.apply_allocation_sweep(
+        alive_ids, expired_ids, DELETE_TIMEOUT)
+    db.mark_boots_seen()
+    deleted = len(deleted_ids)
+    if alive_ids:
+        events.bus.publish("seen", names=[tokens[id] for id in alive_ids],
+                           time=now.isoformat())
+    if deleted_ids:
+        events.bus.publish("expired", names=[tokens[id] for id in deleted_ids])
+    duration = time.monotonic() - started
+    metrics.allocation_sweep_seconds.observe(duration)
+    metrics.allocation_sweep_alive.set(updated)
+    metrics.allocation_expired.inc(amount=deleted)
+    metrics.allocations.set(len(machines_list) - deleted)
+    if deleted or duration > RESTART_DELETE_THREAD:
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+    log.log(level, f"Allocation sweep ({config.liveness_mode}): {len(machines_list)} machines, {len(ips)} probed, "
+                   f"{updated} alive, {deleted} expired in {duration:.3f}s")
 
-class PingThread(threading.Thread):
-    def __init__(self, ip, id):
-        super(PingThread, self).__init__()
-        self.Ip = ip
-        self.Id = id
 
-    def run(self):
-        if self.Ip is None:
-            return
-        if ping_client(self.Ip) == False:
-            date = db.get_image_allocation_time_id(self.Id)
-            if date is None:
-                return
-            delta = datetime.datetime.utcnow() - date
-            if delta.total_seconds() > DELETE_TIMEOUT:
-                db.del_image_allocation_id(self.Id)
-                print("deleted:", self.Id)
-        else:
-            db.update_image_allocation_time(self.Id)
+def purge_sessions_thread_function(stop):
+    while not stop.is_set():
+        try:
+            purged = db.purge_auth_tokens()
+            if purged:
+                log.info(f"Purged {purged} expired auth tokens")
+            purged = db.purge_boots(config.boot_retention_days)
+            if purged:
+                log.info(f"Purged {purged} boot records")
+        except Exception as ex:
+            log.warning(f"Purging expired records failed: {ex}")
+        stop.wait(config.session_purge_interval)
 
 
 def init_threads():
-    ssh_thread = threading.Thread(target=ssh_thread_function)
-    ssh_thread.start()
-
-    allocation_thread = threading.Thread(
-        target=check_allocation_thread_function)
-    allocation_thread.start()
+    # every worker buffers heartbeats of its own requests; wssh and the
+    # allocation monitor run once per deployment, see services.py
+    heartbeat_thread = threading.Thread(
+        target=heartbeat.flush_thread_function, daemon=True)
+    heartbeat_thread.start()
+
+    invalidation_thread = threading.Thread(
+        target=invalidation.listen_thread_function, daemon=True)
+    invalidation_thread.start()
+
+    relay_thread = threading.Thread(
+        target=invalidation.relay_thread_function, daemon=True)
+    relay_thread.start()
+
+    boots_thread = threading.Thread(
+        target=boots.flush_thread_function, daemon=True)
+    boots_thread.start()
 
 
 def is_valid_ip_address(ip: str) -> bool: